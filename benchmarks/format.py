@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Syntax: ./format.py [number-of-lines ...]
+#
+# Compares the old search-and-replace Build.format with the compiled
+# template engine on large multi-line build.run scripts. The results
+# are printed as JSON.
+#
+import sys, re, time, json
+from sci.template import render
+
+re_var = re.compile("{{(.*?)}}")
+ENV = {"PRODUCT": "nexus_s", "VARIANT": "userdebug", "NUMBER_CPUS": "32",
+       "BRANCH": "gingerbread", "SCI_BUILD_ID": "GINGERBREAD_20111010"}
+
+
+def old_format(tmpl, lookup):
+    while True:
+        m = re_var.search(tmpl)
+        if not m:
+            break
+        name = m.groups()[0]
+        value = lookup(name)
+        if not value:
+            raise Exception("Failed to replace template variable %s" % name)
+        tmpl = tmpl.replace("{{%s}}" % name, str(value))
+    return tmpl
+
+
+def make_script(lines):
+    return "\n".join([". build/envsetup.sh",
+                      "lunch {{PRODUCT}}-{{VARIANT}}"] +
+                     ["make -j{{NUMBER_CPUS}} module_%d "
+                      "# {{BRANCH}} {{SCI_BUILD_ID}}" % i
+                      for i in range(lines)])
+
+
+def measure(fn, tmpl, repeat):
+    start = time.time()
+    for i in range(repeat):
+        fn(tmpl, ENV.get)
+    return (time.time() - start) / repeat
+
+
+def main(sizes):
+    results = []
+    for lines in sizes:
+        tmpl = make_script(lines)
+        assert old_format(tmpl, ENV.get) == render(tmpl, ENV.get)
+        repeat = max(10000 / (lines + 1), 3)
+        old = measure(old_format, tmpl, repeat)
+        new = measure(render, tmpl, repeat)
+        results.append({"lines": lines,
+                        "old_us": round(old * 1e6, 1),
+                        "new_us": round(new * 1e6, 1),
+                        "speedup": round(old / new, 1)})
+    print(json.dumps({"benchmark": "format", "results": results}, indent = 2))
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1, 10, 100, 1000])
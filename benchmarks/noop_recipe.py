@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Description:
+#    Has the shape of samples/build-android.py - a manifest step, a
+#    matrix of async jobs and zipped results - but every command is
+#    a no-op, so that only SCI's own overhead is left.
+#
+# Parameters:
+#  BRANCH:
+#    description: Manifest branch
+#    required: True
+#
+#  PRODUCTS:
+#    description: The products to build
+#    type: array
+#
+#  VARIANTS:
+#    description: Variants to build
+#    type: array
+#
+import time
+from sci import Build
+
+build = Build(__name__)
+
+
+@build.step("Create Build ID")
+def create_build_id():
+    return build.env['BRANCH'].upper() + "_" + time.strftime("%Y%m%d_%H%M%S")
+
+
+@build.step("Create Static Manifest")
+def create_manifest():
+    build.run("true repo init -b {{BRANCH}}")
+    build.run("true repo sync")
+    build.run("echo '<manifest/>' > static_manifest.xml")
+    build.artifacts.add("static_manifest.xml")
+
+
+@build.step("Get source code")
+def get_source():
+    build.run("true repo init -b {{BRANCH}}")
+    build.run("true repo sync")
+
+
+@build.step("Build Android")
+def build_android():
+    build.run("""
+mkdir -p out/target/product/{{PRODUCT}}
+for img in boot system userdata; do
+    echo {{PRODUCT}}-{{VARIANT}} > out/target/product/{{PRODUCT}}/$img.img
+done""")
+
+
+@build.step("ZIP resulted files")
+def zip_result():
+    zip_file = "result-{{SCI_BUILD_ID}}-{{PRODUCT}}-{{VARIANT}}.zip"
+    build.artifacts.create_zip(zip_file, "out/target/product/{{PRODUCT}}/*.img")
+    return build.format(zip_file)
+
+
+@build.async()
+@build.step("Run single asynchronous job")
+def run_single_job(product, variant):
+    build.env["PRODUCT"] = product
+    build.env["VARIANT"] = variant
+    build.artifacts.get("static_manifest.xml")
+
+    get_source()
+    build_android()
+    return zip_result()
+
+
+@build.step("Run matrix jobs")
+def run_matrix_jobs():
+    results = build.matrix(run_single_job, max_in_flight = 8,
+                           product = build.env["PRODUCTS"],
+                           variant = build.env["VARIANTS"])
+    return results.get()
+
+
+@build.main()
+def main():
+    build.build_id = create_build_id()
+    create_manifest()
+    return run_matrix_jobs()
+
+
+if __name__ == "__main__":
+    build.start()
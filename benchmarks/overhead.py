@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Syntax: ./overhead.py [--zygote] [number-of-builds]
+#
+# Measures SCI's own overhead by running builds of noop_recipe.py
+# against local stub job and storage servers, the way a slave runs
+# them. Reports p50/p99 of:
+#
+#   job_start_ms     from the slave picking up a job until the recipe runs
+#   slog_ms          from a slog item being created until it is received
+#   dispatch_ms      from dispatching an async job until its result is in
+#   artifact_put_ms, artifact_get_ms
+#                    storing and fetching a 1 MB artifact
+#
+# as well as the build times and artifact throughput. The results are
+# printed as JSON.
+#
+import sys, os, time, json, tempfile, shutil, subprocess
+from sci.http_client import HttpClient
+from sci.session import Session
+from sci.build import Build
+from sci.environment import Environment
+from sci.artifacts import Artifacts
+from sci.zygote import Zygote
+from stubs import JobServer, StorageServer
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+RUN_JOB = os.path.join(HERE, "..", "run_job.py")
+PARAMETERS = {"BRANCH": "gingerbread",
+              "PRODUCTS": ["nexus_one", "nexus_s"],
+              "VARIANTS": ["eng", "userdebug", "user"]}
+ARTIFACTS = 50
+ARTIFACT_SIZE = 1024 * 1024
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda p: values[min(int(len(values) * p), len(values) - 1)]
+    return {"n": len(values), "p50": round(pick(0.50), 2),
+            "p99": round(pick(0.99), 2), "max": round(values[-1], 2)}
+
+
+class Runner(object):
+    """Does what ExecutionThread.run_item does, minus the web app"""
+    def __init__(self, root, zygote = None):
+        self.root = root
+        self.zygote = zygote
+        self.job_start = []
+
+    def __call__(self, session_id):
+        start = time.time()
+        info = self.js.call('/agent/session/%s' % session_id, recipe_ref = 1)
+        session = Session.create(session_id)
+        info['spawn_time'] = time.time()
+        proc = None
+        if self.zygote:
+            proc = self.zygote.spawn(self.js.url, session_id, info,
+                                     session.logfile)
+        if not proc:
+            proc = subprocess.Popen([sys.executable, RUN_JOB, self.js.url,
+                                     session_id], stdin = subprocess.PIPE,
+                                    stdout = open(session.logfile, "w"),
+                                    stderr = subprocess.STDOUT,
+                                    cwd = self.root)
+            proc.stdin.write(json.dumps(info))
+            proc.stdin.close()
+        if proc.wait() != 0:
+            raise Exception("Job %s failed, see %s" % (session_id,
+                                                      session.logfile))
+        session = Session.load(session_id)
+        self.job_start.append((info['spawn_time'] - start) * 1000 +
+                              session.startup_time)
+        return {"result": "success", "output": session.return_value}
+
+
+def run_builds(js, runner, count):
+    times = []
+    dispatch = []
+    for i in range(count):
+        session_id = js.create_build(PARAMETERS)
+        start = time.time()
+        runner(session_id)
+        times.append((time.time() - start) * 1000)
+        for line in js.slogs[session_id]:
+            item = json.loads(line)
+            if item["type"] == "async-joined":
+                dispatch.append(item["params"]["time"])
+    return times, dispatch
+
+
+def measure_artifacts(ss_url):
+    """Stores and fetches artifacts through Artifacts, like a recipe"""
+    build = Build(__name__)
+    build.session = Session.create("artifacts-bench")
+    build.build_uuid = "artifacts-bench"
+    build.env = Environment()
+    build.slog = lambda item, **kwargs: None
+    artifacts = Artifacts(build, ss_url)
+    workspace = build.session.workspace
+    data = os.urandom(ARTIFACT_SIZE)
+    put, get = [], []
+    for i in range(ARTIFACTS):
+        name = "artifact-%d.bin" % i
+        with open(os.path.join(workspace, name), "wb") as f:
+            # Unique contents, so that nothing is deduplicated
+            f.write(data + str(i))
+        start = time.time()
+        artifacts.add(name)
+        put.append((time.time() - start) * 1000)
+    for i in range(ARTIFACTS):
+        name = "artifact-%d.bin" % i
+        start = time.time()
+        artifacts.get(name, os.path.join(workspace, "fetched-" + name))
+        get.append((time.time() - start) * 1000)
+    mb = ARTIFACTS * ARTIFACT_SIZE / (1024.0 * 1024)
+    return put, get, {"put_mb_per_s": round(mb / (sum(put) / 1000), 1),
+                      "get_mb_per_s": round(mb / (sum(get) / 1000), 1)}
+
+
+def main(count, use_zygote):
+    root = tempfile.mkdtemp(prefix = "sci-bench-")
+    Session.set_root_path(root)
+    recipe = open(os.path.join(HERE, "noop_recipe.py")).read()
+    storage = StorageServer().start()
+    zygote = None
+    if use_zygote:
+        zygote = Zygote(RUN_JOB, root)
+        zygote.start()
+    runner = Runner(root, zygote)
+    js = JobServer(recipe, storage.url, runner).start()
+    runner.js = HttpClient(js.url)
+    try:
+        build_times, dispatch = run_builds(js, runner, count)
+        put, get, throughput = measure_artifacts(storage.url)
+    finally:
+        if zygote:
+            zygote.stop()
+        js.stop()
+        storage.stop()
+        shutil.rmtree(root, ignore_errors = True)
+
+    print(json.dumps({"benchmark": "overhead",
+                      "zygote": use_zygote,
+                      "builds": count,
+                      "jobs": len(runner.job_start),
+                      "results": {
+                          "build_ms": percentiles(build_times),
+                          "job_start_ms": percentiles(runner.job_start),
+                          "slog_ms": percentiles([t * 1000 for t in
+                                                  js.slog_latency]),
+                          "dispatch_ms": percentiles(dispatch),
+                          "artifact_put_ms": percentiles(put),
+                          "artifact_get_ms": percentiles(get),
+                          "artifacts": throughput}}, indent = 2))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    use_zygote = "--zygote" in args
+    args = [a for a in args if a != "--zygote"]
+    main(int(args[0]) if args else 5, use_zygote)
@@ -0,0 +1,315 @@
+"""
+    Stub servers for benchmarking
+
+    Minimal in-process stand-ins for the SCI job and storage servers,
+    serving on localhost. They implement just enough of the protocol
+    for the benchmarks to run without a real deployment.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import BaseHTTPServer, SocketServer, threading, json, urlparse, os, shutil
+import tempfile, hashlib, time
+from sci.recipe_cache import RecipeCache
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data, status = 200, headers = {}):
+        body = data if isinstance(data, str) else json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k in headers:
+            self.send_header(k, headers[k])
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def body_to(self, f):
+        left = int(self.headers.get("Content-Length", 0))
+        while left > 0:
+            data = self.rfile.read(min(left, 1024 * 1024))
+            if not data:
+                break
+            f.write(data)
+            left -= len(data)
+
+    def route(self):
+        u = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(u.query))
+        return u.path, query
+
+
+class StorageHandler(StubHandler):
+    """Serves /f/<build_uuid>/<filename>, including chunked uploads"""
+
+    def filename(self, path):
+        return os.path.join(self.server.root, path[len("/f/"):])
+
+    def do_PUT(self):
+        path, query = self.route()
+        if "upload_id" in query:
+            upload = self.server.uploads[query["upload_id"]]
+            part = int(query["part"])
+            with open(upload["file"], "r+b") as f:
+                f.seek(part * upload["chunk_size"])
+                self.body_to(f)
+            upload["parts"].add(part)
+        else:
+            fname = self.filename(path)
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            if "offset" in query:
+                # Appending to a file, e.g. a log that is being written
+                with open(fname, "ab") as f:
+                    f.truncate(int(query["offset"]))
+                    self.body_to(f)
+                    f.flush()
+                    size = os.fstat(f.fileno()).st_size
+            else:
+                with open(fname, "wb") as f:
+                    self.body_to(f)
+            if "sha1" in query:
+                self.server.digests[query["sha1"]] = fname
+        self.server.stats["put"] += 1
+        reply = {"status": "ok", "url": "http://stub%s" % path}
+        if "offset" in query:
+            reply["size"] = size
+        self.reply(reply)
+
+    def do_POST(self):
+        path, query = self.route()
+        if not query:
+            # A reference to contents that we may already have
+            digest = json.loads(self.body())["sha1"]
+            if digest not in self.server.digests:
+                return self.reply("Not found", 404)
+            fname = self.filename(path)
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            shutil.copyfile(self.server.digests[digest], fname)
+            self.server.stats["ref"] += 1
+            return self.reply({"status": "ok", "url": "http://stub%s" % path})
+        if not self.server.multipart:
+            self.body()
+            return self.reply("Not found", 404)
+        if "uploads" in query:
+            info = json.loads(self.body())
+            upload_id = hashlib.sha1(path + str(len(self.server.uploads)))
+            upload_id = upload_id.hexdigest()
+            fname = os.path.join(self.server.root, "upload-" + upload_id)
+            with open(fname, "wb") as f:
+                f.truncate(info["size"])
+            self.server.uploads[upload_id] = {"file": fname, "parts": set(),
+                                              "chunk_size": info["chunk_size"]}
+            return self.reply({"upload_id": upload_id})
+        if "complete" in query:
+            self.body()
+            upload = self.server.uploads.pop(query["upload_id"])
+            fname = self.filename(path)
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            os.rename(upload["file"], fname)
+            if "sha1" in query:
+                self.server.digests[query["sha1"]] = fname
+            return self.reply({"status": "ok", "url": "http://stub%s" % path})
+        self.reply("Not found", 404)
+
+    def do_GET(self):
+        path, query = self.route()
+        if "upload_id" in query:
+            upload = self.server.uploads.get(query["upload_id"])
+            if not upload:
+                return self.reply("Not found", 404)
+            return self.reply({"parts": sorted(upload["parts"])})
+        fname = self.filename(path)
+        if not os.path.exists(fname):
+            return self.reply("Not found", 404)
+        st = os.stat(fname)
+        self.send_response(200)
+        self.send_header("Content-Length", str(st.st_size))
+        self.send_header("ETag", '"%d-%d"' % (st.st_mtime, st.st_size))
+        self.end_headers()
+        self.server.stats["get"] += 1
+        if self.command != "HEAD":
+            with open(fname, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    do_HEAD = do_GET
+
+
+class JobHandler(StubHandler):
+    """Serves the /agent, /slog and /build calls that slaves and jobs make"""
+
+    def do_GET(self):
+        path, query = self.route()
+        parts = path.strip("/").split("/")
+        if path.startswith("/agent/session/"):
+            info = dict(self.server.sessions[parts[2]])
+            if "recipe_ref" in query:
+                info["recipe_ref"] = self.server.recipe_ref
+                del info["recipe"]
+            return self.reply(info)
+        if path.startswith("/agent/recipe/"):
+            return self.reply({"recipe": self.server.recipe})
+        if path.startswith("/agent/result/"):
+            return self.reply(self.server.results.get(parts[2], {}))
+        if path.startswith("/agent/env/"):
+            return self.reply(self.server.envs[parts[3]])
+        if path.startswith("/slog/"):
+            return self.reply("\n".join(self.server.slogs.get(parts[1], [])))
+        self.reply("Not found", 404)
+
+    def do_PUT(self):
+        path, query = self.route()
+        parts = path.strip("/").split("/")
+        data = self.body()
+        if path.startswith("/agent/env/"):
+            self.server.envs[parts[3]] = data
+            return self.reply({"status": "ok"})
+        self.reply("Not found", 404)
+
+    def do_POST(self):
+        path, query = self.route()
+        parts = path.strip("/").split("/")
+        data = self.body()
+        if path.startswith("/slog/"):
+            self.server.add_slog(parts[1], data.split("\n"))
+            return self.reply({"status": "ok"})
+        if path == "/agent/dispatch":
+            return self.reply({"session_id":
+                               self.server.dispatch(json.loads(data))})
+        if path == "/agent/dispatch/bulk":
+            jobs = json.loads(data)["jobs"]
+            return self.reply({"session_ids": [self.server.dispatch(job)
+                                               for job in jobs]})
+        if path == "/agent/results":
+            req = json.loads(data)
+            return self.reply({"results": self.server.wait_results(
+                req["session_ids"], req["timeout"])})
+        if path.startswith("/agent/") or path.startswith("/build/"):
+            # Registration, pings and state changes are just accepted
+            return self.reply({"status": "ok"})
+        self.reply("Not found", 404)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StorageServer(StubServer):
+    def __init__(self, multipart = True):
+        StubServer.__init__(self, StorageHandler)
+        self.root = tempfile.mkdtemp(prefix = "sci-stub-storage-")
+        self.multipart = multipart
+        self.uploads = {}
+        self.digests = {}
+        self.stats = {"put": 0, "get": 0, "ref": 0}
+
+    def stop(self):
+        StubServer.stop(self)
+        shutil.rmtree(self.root, ignore_errors = True)
+
+
+class JobServer(StubServer):
+    """Runs builds of a single recipe
+
+       Dispatched jobs are run by calling run(session_id) in a thread
+       of their own, which should return the session's result."""
+    def __init__(self, recipe, ss_url, run):
+        StubServer.__init__(self, JobHandler)
+        self.recipe = recipe
+        self.recipe_ref = RecipeCache.ref(recipe)
+        self.ss_url = ss_url
+        self.run = run
+        self.cv = threading.Condition()
+        self.builds = 0
+        self.session_counts = {}
+        self.sessions = {}
+        self.results = {}
+        self.slogs = {}
+        # Environment snapshots, by version
+        self.envs = {}
+        # Seconds from a slog item being created until it was received
+        self.slog_latency = []
+
+    def _new_session(self, build_uuid, parameters, run_info):
+        with self.cv:
+            n = self.session_counts.get(build_uuid, 0)
+            self.session_counts[build_uuid] = n + 1
+        session_id = "%s-%d" % (build_uuid, n)
+        self.sessions[session_id] = {"build_uuid": build_uuid,
+                                     "build_name": build_uuid.upper(),
+                                     "parameters": parameters,
+                                     "recipe": self.recipe,
+                                     "ss_url": self.ss_url,
+                                     "run_info": run_info}
+        return session_id
+
+    def create_build(self, parameters):
+        """Returns the session id of a new build's main job"""
+        with self.cv:
+            self.builds += 1
+            build_uuid = "build%d" % self.builds
+        return self._new_session(build_uuid, parameters, {})
+
+    def dispatch(self, data):
+        session_id = self._new_session(data["build_id"], {},
+                                       data["run_info"])
+        t = threading.Thread(target = self._run, args = (session_id,))
+        t.daemon = True
+        t.start()
+        return session_id
+
+    def _run(self, session_id):
+        try:
+            result = self.run(session_id)
+        except Exception, e:
+            result = {"result": "error", "output": str(e)}
+        with self.cv:
+            self.results[session_id] = result
+            self.cv.notify_all()
+
+    def wait_results(self, session_ids, timeout):
+        deadline = time.time() + timeout
+        with self.cv:
+            while True:
+                done = dict((s, self.results[s]) for s in session_ids
+                            if s in self.results)
+                remaining = deadline - time.time()
+                if done or remaining <= 0:
+                    return done
+                self.cv.wait(remaining)
+
+    def add_slog(self, session_id, lines):
+        now = time.time()
+        with self.cv:
+            self.slogs.setdefault(session_id, []).extend(lines)
+            for line in lines:
+                ts = json.loads(line).get("ts")
+                if ts:
+                    self.slog_latency.append(now - ts / 1000.0)
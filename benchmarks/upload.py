@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Syntax: ./upload.py [size-in-MB ...]
+#
+# Measures artifact upload throughput against a local stub storage
+# server, for a single streamed PUT and for parallel chunked uploads.
+# The results are printed as JSON.
+#
+import sys, os, time, json, tempfile
+from sci.http_client import HttpClient
+from sci.upload import Uploader
+from stubs import StorageServer
+
+MB = 1024 * 1024
+
+
+def make_file(size):
+    fd, fname = tempfile.mkstemp(prefix = "sci-bench-")
+    with os.fdopen(fd, "wb") as f:
+        block = os.urandom(MB)
+        for i in range(size / MB):
+            f.write(block)
+    return fname
+
+
+def measure(server, fname, multipart, threads):
+    state_dir = tempfile.mkdtemp(prefix = "sci-bench-state-")
+    uploader = Uploader(HttpClient(server.url), state_dir, threads = threads,
+                        chunk_size = 8 * MB,
+                        threshold = 0 if multipart else sys.maxint)
+    start = time.time()
+    uploader.upload(fname, "/f/bench/%s" % os.path.basename(fname))
+    return time.time() - start
+
+
+def main(sizes):
+    results = []
+    server = StorageServer().start()
+    try:
+        for size in sizes:
+            fname = make_file(size * MB)
+            try:
+                for name, multipart, threads in (("single", False, 1),
+                                                 ("multipart-1", True, 1),
+                                                 ("multipart-4", True, 4)):
+                    secs = measure(server, fname, multipart, threads)
+                    results.append({"mode": name, "size_mb": size,
+                                    "seconds": round(secs, 4),
+                                    "mb_per_s": round(size / secs, 1)})
+            finally:
+                os.remove(fname)
+    finally:
+        server.stop()
+    print(json.dumps({"benchmark": "upload", "results": results}, indent = 2))
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [16, 256])
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 #
 # Syntax: ./run_job <jobserver> <session_id>
+#         ./run_job --zygote <socket>
 #
 # It should be run with the current working directory set properly
 #
 import sys, json
-from sci.bootstrap import Bootstrap
 
-data = json.loads(sys.stdin.read())
-Bootstrap.run(sys.argv[1], sys.argv[2], data)
+if sys.argv[1] == '--zygote':
+    from sci.zygote import serve
+    serve(sys.argv[2])
+else:
+    from sci.bootstrap import Bootstrap
+    data = json.loads(sys.stdin.read())
+    Bootstrap.run(sys.argv[1], sys.argv[2], data)
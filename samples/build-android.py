@@ -45,7 +45,9 @@
 import time
 from sci import Build
 
-build = Build(__name__, debug = True)
+# Reuse the checkout and build tree of earlier builds of the same branch
+build = Build(__name__, debug = True,
+              workspace = "{{MANIFEST_URL}}:{{BRANCH}}")
 
 
 @build.default("PRODUCTS")
@@ -127,15 +129,14 @@ def run_single_job(product, variant):
 
 @build.step("Run matrix jobs")
 def run_matrix_jobs():
-    """Running jobs asynchronously"""
-    results = []
-    for product in build.env["PRODUCTS"]:
-        for variant in build.env["VARIANTS"]:
-            async_result = run_single_job(product, variant)
-            results.append(async_result)
-
-    for result in results:
-        print("Result: " + result.get())
+    """Running jobs asynchronously. All combinations are dispatched
+       in one request, with at most 8 of them running at a time."""
+    results = build.matrix(run_single_job, max_in_flight = 8,
+                           product = build.env["PRODUCTS"],
+                           variant = build.env["VARIANTS"])
+
+    for result in results.get():
+        print("Result: " + result)
 
 
 @build.step("Send Report")
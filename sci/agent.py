@@ -0,0 +1,486 @@
+"""
+    sci.agent
+    ~~~~~~~~~
+
+    Event Loop Slave
+
+    Does what sci.slave does - serves /dispatch, keeps registered
+    with the job server, runs the jobs and ships their logs - but on
+    a single event loop instead of a web server thread, a status
+    thread and one execution thread per slot. Nothing polls: the
+    heartbeat is a timer, child exits arrive as SIGCHLD and all HTTP
+    calls are non-blocking, so shutdown is immediate and a slave with
+    many slots costs no more threads than one with a single slot.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, json, signal, subprocess, time
+from .daemon import Daemon
+from .session import Session
+from .reaper import SessionReaper, disk_used_fraction
+from .zygote import Zygote, ORPHAN_POLL_INTERVAL
+from .evloop import EventLoop, HttpServer, http_call
+from .http_client import HttpError
+from .log_shipper import SHIP_INTERVAL, MAX_CHUNK, appended
+from .slog import BATCH_SIZE, SPOOL_NAME, read_spool, keep_spooled
+from .jobs import create_session, job_exited, log_url, leftover_spools
+from .metrics import (REGISTRY, JOB_START, LOG_UPLOAD_BYTES,
+                      LOG_UPLOAD_SECONDS, LOG_UPLOAD_TAIL, REGISTRATIONS,
+                      PING_FAILURES, SLOTS, SLOTS_FREE, DISK_USED, RECLAIMED)
+from .resources import ResourceMonitor, pressure
+from .utils import load_node_id
+
+EXPIRY_TTL = 60
+REGISTER_RETRY = 5
+SAMPLE_INTERVAL = 1
+RUN_JOB = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..',
+                       "run_job.py")
+DEFAULT_PORT = 6700
+
+
+def _read(filename, offset, size):
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class Job(object):
+    def __init__(self, session_id, item, slot, received):
+        self.session_id = session_id
+        self.item = item
+        self.slot = slot
+        self.received = received
+        self.session = None
+        self.info = None
+        self.proc = None
+        # Set once the process is spawned and the loop watches it
+        self.started = False
+        self.exited = None
+        self.result = None
+        self.log_url = None
+        self.log_offset = 0
+        self.log_appending = True
+        self.log_result = None
+        self.log_timer = None
+        self.shipping = False
+        self.finished = False
+
+
+class Agent(Daemon):
+    def __init__(self, nickname, jobserver, port = DEFAULT_PORT, path = '.',
+                 slots = 1, zygote = False):
+        self.nick = nickname
+        self.jobserver = jobserver
+        self.port = port
+        self.slots = slots
+        self.use_zygote = zygote
+        self.path = os.path.realpath(path)
+        self.jobs = {}
+        self.registered = False
+        self.registrations = 0
+        self.last_status = 0
+        self.ping_timer = None
+        self.stopping = False
+        self.sending_spools = set()
+        pidfile = '/tmp/scigent_%s' % nickname
+        super(Agent, self).__init__(pidfile,
+                                    stdout='/dev/stdout',
+                                    stderr='/dev/stderr')
+
+    def call(self, path, callback = None, url = None, **kwargs):
+        def done(result, error):
+            if error is not None and callback is None:
+                print("Call to %s failed: %s" % (path, error))
+            if callback:
+                callback(result, error)
+        http_call(self.loop, url or self.jobserver, path, done, **kwargs)
+
+    def free(self):
+        return 0 if self.stopping else self.slots - len(self.jobs)
+
+    def run(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        Session.set_root_path(self.path)
+        # Whatever was running when the agent stopped won't finish now
+        abandoned = Session.store().abandon_running()
+        if abandoned:
+            print("Abandoned %d sessions" % len(abandoned))
+        self.node_id = load_node_id(self.path)
+
+        self.loop = EventLoop()
+        self.reaper = SessionReaper(self.path)
+        self.resources = ResourceMonitor(self.path,
+                                         self.reaper.request_room)
+        self.reaper.start()
+        self.zygote = None
+        if self.use_zygote:
+            self.zygote = Zygote(RUN_JOB, self.path)
+            self.zygote.start()
+        SLOTS.set(self.slots)
+        SLOTS_FREE.set_function(self.free)
+        DISK_USED.set_function(lambda: disk_used_fraction(self.path))
+        RECLAIMED.set_function(lambda: self.reaper.reclaimed)
+
+        self.server = HttpServer(self.loop, ("0.0.0.0", self.port),
+                                 self.handle)
+        self.loop.add_signal_handler(signal.SIGCHLD, self.children_exited)
+        self.loop.add_signal_handler(signal.SIGTERM, self.shutdown)
+        self.loop.add_signal_handler(signal.SIGINT, self.shutdown)
+        self.loop.call_later(0, self.register)
+        self.loop.call_later(SAMPLE_INTERVAL, self.sample_resources)
+        try:
+            self.loop.run()
+        finally:
+            if self.zygote:
+                self.zygote.stop()
+
+    def shutdown(self):
+        """Stops taking jobs, and exits once the running ones are done.
+           A second signal exits at once."""
+        if self.stopping or not self.jobs:
+            self.loop.stop()
+            return
+        print("Shutting down once %d jobs are done" % len(self.jobs))
+        self.stopping = True
+        self.server.close()
+
+    # HTTP
+
+    def handle(self, method, path, body):
+        if path == '/dispatch' and method == 'POST':
+            if not self.resources.accepting:
+                # It may have been cleaned up since
+                self.resources.sample()
+            if not self.resources.accepting:
+                reason = "Low on %s" % " and ".join(
+                    pressure(self.resources.current))
+                print("> %s" % reason)
+                return 412, "text/plain", reason
+            if not self.start_job(body):
+                print("> Busy")
+                return 412, "text/plain", "Busy"
+            return 200, "application/json", json.dumps({"status": "started"})
+        if path == '/metrics' and method == 'GET':
+            return 200, "text/plain; version=0.0.4", REGISTRY.render()
+        return 404, "text/plain", "Not found"
+
+    # Heartbeats
+
+    def register(self):
+        print("Registering")
+        self.last_status = time.time()
+        info = {"id": self.node_id,
+                'nick': self.nick,
+                "port": self.port,
+                "slots": self.slots,
+                "labels": [os.uname()[0], os.uname()[4]]}
+        info.update(self.resources.report())
+        self.call("/agent/register", self._registered, input = info)
+
+    def _registered(self, result, error):
+        if error is not None:
+            print("Failed to register. Will try again")
+            self.registered = False
+            self.loop.call_later(REGISTER_RETRY, self.register)
+            return
+        print("%s registered - listening to %d" % (self.node_id, self.port))
+        self.registered = True
+        self.registrations += 1
+        REGISTRATIONS.inc(kind = "initial" if self.registrations == 1
+                          else "re-registration")
+        self.ping_timer = self.loop.call_later(EXPIRY_TTL, self.ping)
+
+    def ping(self, early = False):
+        # Checking in when jobs start and finish counts as a ping
+        remaining = self.last_status + EXPIRY_TTL - time.time()
+        if remaining > 0 and not early:
+            self.ping_timer = self.loop.call_later(remaining, self.ping)
+            return
+        self.ping_timer.cancel()
+        self.ping_timer = None
+        print("%s pinging" % self.node_id)
+        self.last_status = time.time()
+        self.call("/agent/ping/%s" % self.node_id, self._pinged,
+                  input = self.resources.report())
+
+    def _pinged(self, result, error):
+        if error is not None:
+            print("Exception while pinging - re-registering")
+            PING_FAILURES.inc()
+            self.registered = False
+            self.loop.call_later(REGISTER_RETRY, self.register)
+            return
+        self.ping_timer = self.loop.call_later(EXPIRY_TTL, self.ping)
+        self.send_spools()
+
+    def send_spools(self):
+        """Sends what jobs have left in their slog spools, because the
+           job server couldn't be reached when they ended"""
+        busy = set(self.jobs) | self.sending_spools
+        for session_id, filename in leftover_spools(self.path, busy):
+            self.send_spool(session_id, filename)
+
+    def send_spool(self, session_id, filename, callback = None):
+        """Sends the spooled items of a session, a batch at a time.
+           callback(sent) is called once done."""
+        self.sending_spools.add(session_id)
+        try:
+            lines = read_spool(filename)
+        except IOError:
+            lines = []
+
+        def finish(sent):
+            self.sending_spools.discard(session_id)
+            if callback:
+                callback(sent)
+
+        def send(i):
+            if i >= len(lines):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                return finish(True)
+
+            def done(result, error):
+                if error is None:
+                    return send(i + BATCH_SIZE)
+                print("Failed to send spooled slog of %s (%s) - will try "
+                      "again when pinging" % (session_id, error))
+                try:
+                    # Keep what is left, so nothing is sent twice
+                    keep_spooled(filename, lines[i:])
+                except (IOError, OSError):
+                    pass
+                finish(False)
+            self.call('/slog/%s' % session_id, done,
+                      input = "\n".join(lines[i:i + BATCH_SIZE]), raw = True)
+        send(0)
+
+    def sample_resources(self):
+        # Sharp changes in the resources are reported early
+        self.resources.sample()
+        if self.ping_timer and self.resources.should_report():
+            self.ping(early = True)
+        self.loop.call_later(SAMPLE_INTERVAL, self.sample_resources)
+
+    # Jobs
+
+    def start_job(self, item):
+        """Returns False if all slots are working"""
+        if self.free() <= 0:
+            return False
+        session_id = json.loads(item)['session_id']
+        used = set(job.slot for job in self.jobs.values())
+        slot = min(set(range(self.slots)) - used)
+        job = Job(session_id, item, slot, time.time())
+        self.jobs[session_id] = job
+        # Ask for just the recipe's ref - the job fetches the recipe
+        # itself if it isn't cached on this node.
+        self.call('/agent/session/%s' % session_id,
+                  lambda info, error: self._spawn(job, info, error),
+                  recipe_ref = 1)
+        return True
+
+    def _spawn(self, job, info, error):
+        if error is not None:
+            print("Failed to fetch session %s: %s" % (job.session_id, error))
+            self._release(job)
+            return
+        job.info = info
+        # Reclaiming disk space and spawning both block - leave the
+        # loop to it.
+        self.loop.run_in_thread(self._start_process,
+                                lambda result, error: self._started(job,
+                                                                    error),
+                                job, info)
+
+    def _start_process(self, job, info):
+        job.session = create_session(self.reaper, job.session_id, info)
+        if self.zygote:
+            job.proc = self.zygote.spawn(self.jobserver, job.session_id,
+                                         info, job.session.logfile)
+        if not job.proc:
+            stdout = open(job.session.logfile, "w")
+            job.proc = subprocess.Popen([RUN_JOB, self.jobserver,
+                                         job.session_id],
+                                        stdin = subprocess.PIPE,
+                                        stdout = stdout,
+                                        stderr = subprocess.STDOUT,
+                                        cwd = self.path)
+            stdout.close()
+            job.proc.stdin.write(json.dumps(info))
+            job.proc.stdin.close()
+
+    def _started(self, job, error):
+        if error is not None:
+            print("Failed to start session %s" % job.session_id)
+            if isinstance(job.proc, subprocess.Popen) and \
+                    job.proc.poll() is None:
+                job.proc.kill()
+                job.proc.wait()
+            if job.session:
+                job.session.state = "done"
+                job.session.save()
+            self._release(job)
+            return
+        if not isinstance(job.proc, subprocess.Popen):
+            # The zygote writes the return code when the job exits
+            self.loop.add_reader(job.proc.sock.fileno(),
+                                 lambda: self._zygote_child_exited(job))
+        JOB_START.observe(time.time() - job.received)
+        job.log_url = "/f/%s/%s.log" % (job.info['build_uuid'],
+                                         job.session_id)
+        job.log_timer = self.loop.call_later(SHIP_INTERVAL, self.ship_log,
+                                             job)
+        self.check_in("busy", job)
+        job.started = True
+        # Its SIGCHLD may have come before the loop knew of the process
+        self.children_exited()
+
+    def children_exited(self):
+        for job in self.jobs.values():
+            if job.started and job.exited is None and \
+                    isinstance(job.proc, subprocess.Popen):
+                if job.proc.poll() is not None:
+                    self.job_exited(job, job.proc.returncode)
+
+    def _zygote_child_exited(self, job):
+        self.loop.remove_reader(job.proc.sock.fileno())
+        job.proc.read_result()
+        if job.proc.orphaned:
+            self._wait_orphan(job)
+        else:
+            self.job_exited(job, job.proc.returncode)
+
+    def _wait_orphan(self, job):
+        """The zygote has died, but not the job - its slot stays busy
+           until the process is gone"""
+        if job.proc.running():
+            self.loop.call_later(ORPHAN_POLL_INTERVAL, self._wait_orphan,
+                                 job)
+        else:
+            self.job_exited(job, None)
+
+    def job_exited(self, job, return_code):
+        job.exited = time.time()
+        job.session, job.result = job_exited(job.session_id, job.item,
+                                             job.info, return_code)
+        job.log_timer.cancel()
+        self.ship_log(job)
+
+    def ship_log(self, job):
+        """Appends what has been written to the job's log since last
+           time to the storage server. Once the job has exited, this
+           goes on until all of it is sent, and then finishes the job."""
+        if job.shipping:
+            return
+        size = os.path.getsize(job.session.logfile)
+        if job.log_appending and job.log_offset < size:
+            n = min(size - job.log_offset, MAX_CHUNK)
+            self._put_log(job, _read(job.session.logfile, job.log_offset, n),
+                          job.log_offset)
+        elif job.exited is None:
+            job.log_timer = self.loop.call_later(SHIP_INTERVAL,
+                                                 self.ship_log, job)
+        elif not job.log_appending:
+            # The storage server can't append - send it all at once
+            self._put_log(job, None, None, True)
+        elif job.log_result is None:
+            # Nothing was ever written
+            self._put_log(job, "", None, True)
+        else:
+            self.finish_job(job)
+
+    def _put_log(self, job, data, offset, last = False):
+        """Sends `data`, or the whole log if it is None"""
+        job.shipping = True
+        start = time.time()
+        if data is None:
+            size = os.path.getsize(job.session.logfile)
+            body = {'input_file': job.session.logfile}
+        else:
+            size = len(data)
+            body = {'input': data}
+
+        def done(result, error):
+            job.shipping = False
+            LOG_UPLOAD_SECONDS.inc(time.time() - start)
+            if error is None:
+                LOG_UPLOAD_BYTES.inc(size)
+                job.log_result = result
+                if last:
+                    return self.finish_job(job)
+                if appended(result, offset + size):
+                    job.log_offset += size
+                else:
+                    print("The storage server can't append to %s - "
+                          "sending all of it at the end" % job.log_url)
+                    job.log_appending = False
+            elif isinstance(error, HttpError) and offset is not None and \
+                    error.code in (400, 404, 405):
+                job.log_appending = False
+            elif job.exited is not None:
+                print("Failed to ship log %s: %s" % (job.session.logfile,
+                                                     error))
+                job.log_result = {'status': 'error'}
+                return self.finish_job(job)
+            else:
+                # We'll try again later, or at the end.
+                print("Failed to ship log %s: %s" % (job.session.logfile,
+                                                     error))
+            if job.exited is not None:
+                self.ship_log(job)
+            else:
+                job.log_timer = self.loop.call_later(SHIP_INTERVAL,
+                                                     self.ship_log, job)
+
+        params = {} if offset is None else {'offset': offset}
+        params.update(body)
+        self.call(job.log_url, done, url = job.info['ss_url'],
+                  method = "PUT", **params)
+
+    def finish_job(self, job):
+        if job.finished:
+            return
+        job.finished = True
+        LOG_UPLOAD_TAIL.observe(time.time() - job.exited)
+        # Items the job couldn't send go to the job server before the
+        # job is reported as done
+        spool = os.path.join(job.session.path, SPOOL_NAME)
+        if os.path.exists(spool):
+            self.send_spool(job.session_id, spool,
+                            lambda sent: self._check_in_finished(job))
+        else:
+            self._check_in_finished(job)
+
+    def _check_in_finished(self, job):
+        self.check_in("available", job, result = job.result,
+                      output = job.session.return_value,
+                      log_file = log_url(job.log_result))
+
+    def check_in(self, state, job, **kwargs):
+        self.last_status = time.time()
+        print("%s checking in (%s, slot %d)" % (self.node_id, state,
+                                                job.slot))
+        kwargs.update(session_id = job.session_id, slot = job.slot)
+
+        def done(result, error):
+            if error is not None:
+                print("Failed to check in (%s): %s" % (state, error))
+            if state == "available":
+                self.job_done(job)
+        self.call("/agent/%s/%s" % (state, self.node_id), done,
+                  input = kwargs)
+
+    def job_done(self, job):
+        self.reaper.finished(job.session)
+        self._release(job)
+
+    def _release(self, job):
+        """Frees the job's slot"""
+        del self.jobs[job.session_id]
+        if self.stopping and not self.jobs:
+            self.loop.stop()
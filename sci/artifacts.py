@@ -11,9 +11,12 @@
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
-import os, shutil, zipfile, glob
+import os, shutil, glob
 from sci.slog import ArtifactAdded
-from .http_client import HttpClient, HttpRequest
+from .http_client import HttpClient, HttpError
+from .upload import Uploader
+from .parallel_zip import ParallelZipFile, DEFAULT_LEVEL
+from .utils import file_sha1
 
 
 class ArtifactException(Exception):
@@ -28,6 +31,8 @@ class Artifact(object):
 class ArtifactsBase(object):
     def __init__(self, job):
         self.job = job
+        # (remote filename, filename relative to the workspace)
+        self.added = []
 
     def _add(self, local_filename, remote_filename, **kwargs):
         raise NotImplemented()
@@ -45,10 +50,15 @@ class ArtifactsBase(object):
             remote_filename = os.path.relpath(local_filename,
                                               self.job.session.workspace)
         url = self._add(local_filename, remote_filename, **kwargs)
+        self.added.append((remote_filename,
+                           os.path.relpath(local_filename,
+                                           self.job.session.workspace)))
         self.job.slog(ArtifactAdded(remote_filename, url, description))
         return Artifact(remote_filename)
 
-    def get(self, remote_filename, local_filename = None, **kwargs):
+    def get(self, remote_filename, local_filename = None, build_uuid = None,
+            **kwargs):
+        """Fetches an artifact of this build, or of `build_uuid`"""
         if local_filename is None:
             local_filename = os.path.join(self.job.session.workspace,
                                           remote_filename)
@@ -56,13 +66,20 @@ class ArtifactsBase(object):
             os.makedirs(os.path.dirname(local_filename))
         except OSError:
             pass
-        return self._get(remote_filename, local_filename)
+        return self._get(remote_filename, local_filename,
+                         build_uuid = build_uuid or self.job.build_uuid)
 
     def _get(self, remote_filename, local_filename, **kwargs):
         raise NotImplemented()
 
     def create_zip(self, zip_filename, input_files, upload = True,
-                   description = "", **kwargs):
+                   description = "", level = DEFAULT_LEVEL, workers = None,
+                   **kwargs):
+        """Zips the files matching `input_files`, using all cores
+
+           `level` is the deflate level (0 stores everything) and
+           `workers` the number of compression threads. Files that
+           are already compressed are stored as they are."""
         zip_filename = self.job.format(zip_filename, **kwargs)
         input_files = self.job.format(input_files, **kwargs)
 
@@ -74,7 +91,7 @@ class ArtifactsBase(object):
         input_files = os.path.join(self.job.session.workspace,
                                    input_files)
 
-        zf = zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED)
+        zf = ParallelZipFile(zip_filename, "w", level, workers)
         for fname in glob.iglob(input_files):
             zf.write(fname, os.path.relpath(fname, self.job.session.workspace))
         zf.close()
@@ -85,22 +102,74 @@ class ArtifactsBase(object):
 
 
 class Artifacts(ArtifactsBase):
-    def __init__(self, job, storage_server):
+    def __init__(self, job, storage_server, cache = None, hash_cache = None):
         ArtifactsBase.__init__(self, job)
         self.client = HttpClient(storage_server)
         self.url = storage_server
+        self.cache = cache
+        # Where the digests of the uploaded files are kept
+        self.hash_cache = hash_cache
+        self.uploader = Uploader(self.client,
+                                 os.path.join(job.session.path, "uploads"))
+        self.dedup = True
+
+    def _add_reference(self, url, digest):
+        """Asks the storage server to store a file that it already has
+           the contents of. Returns None if it doesn't have them."""
+        try:
+            return self.client.call(url, input = {'sha1': digest})
+        except HttpError, e:
+            if e.code == 405:
+                # Not supported by this storage server
+                self.dedup = False
+            elif e.code != 404:
+                raise
+        return None
 
     def _add(self, local_filename, remote_filename, **kwargs):
         url = "/f/%s/%s" % (self.job.build_uuid, remote_filename)
-        result = self.client.call(url, method = "PUT",
-                                  input = open(local_filename, "rb"))
+        digest = file_sha1(local_filename, self.hash_cache)
+        result = None
+        if self.dedup:
+            result = self._add_reference(url, digest)
+        if result is None:
+            result = self.uploader.upload(local_filename, url, sha1 = digest)
         if result["status"] != "ok":
             raise ArtifactException("Failed to store %s to server: %s" % \
                                         (local_filename, result["status"]))
         return result['url']
 
-    def _get(self, remote_filename, local_filename, **kwargs):
-        path = "/f/%s/%s" % (self.job.build_uuid, remote_filename)
-        with HttpRequest(self.url, path) as src:
+    def _download(self, path, local_filename):
+        with self.client.request(path) as src:
             with open(local_filename, "wb") as dest:
                 shutil.copyfileobj(src, dest)
+
+    def _validator(self, path):
+        """Returns a string that changes whenever the file changes, or
+           None if the storage server can't tell"""
+        try:
+            with self.client.request(path, method = "HEAD") as head:
+                head.read()
+                etag = head.getheader("etag")
+                if etag:
+                    return etag
+                modified = head.getheader("last-modified")
+                length = head.getheader("content-length")
+                if modified and length:
+                    return "%s/%s" % (modified, length)
+        except HttpError:
+            # Rejects HEAD - the plain GET tells if the file is missing
+            pass
+        return None
+
+    def _get(self, remote_filename, local_filename, build_uuid = None,
+             **kwargs):
+        build_uuid = build_uuid or self.job.build_uuid
+        path = "/f/%s/%s" % (build_uuid, remote_filename)
+        validator = self.cache and self._validator(path)
+        if not validator:
+            self._download(path, local_filename)
+            return
+        key = "%s/%s/%s" % (build_uuid, remote_filename, validator)
+        self.cache.fetch(key, local_filename,
+                         lambda fname: self._download(path, fname))
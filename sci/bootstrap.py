@@ -8,10 +8,12 @@
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
-import os, imp, socket
+import os, imp, socket, time, json
 from datetime import datetime
 from .session import Session
-from .environment import Environment
+from .environment import Environment, env_version, apply_env_delta
+from .recipe_cache import RecipeCache
+from .http_client import HttpClient
 
 
 class Bootstrap(object):
@@ -64,34 +66,92 @@ class Bootstrap(object):
 
         return env
 
+    @classmethod
+    def load_recipe(cls, job_server, info):
+        """Returns (ref, filename, code) of the recipe to run
+
+           The job server may send just the ref of the recipe, in
+           which case it is only fetched if it isn't already cached."""
+        cache = RecipeCache(os.path.join(Session.root_path, "recipes"))
+        if 'recipe' in info:
+            ref = cache.put(info['recipe'])
+        else:
+            ref = info['recipe_ref']
+            if not cache.has(ref):
+                res = HttpClient(job_server).call('/agent/recipe/%s' % ref)
+                if cache.put(res['recipe']) != ref:
+                    raise Exception("Received the wrong recipe")
+        return ref, cache.source_file(ref), cache.load(ref)
+
+    @classmethod
+    def load_env(cls, job_server, run_info):
+        """Returns the environment that an async job was started with
+
+           It is either sent in full, or as changes to a snapshot of
+           the parent's environment. Snapshots are cached on the node,
+           so each is only fetched once."""
+        if run_info.get('env'):
+            return Environment.deserialize(run_info['env'])
+        ref = run_info.get('env_ref')
+        if not ref:
+            return None
+        path = os.path.join(Session.root_path, "cache", "env")
+        fname = os.path.join(path, "%s.json" % ref['version'])
+        try:
+            with open(fname, "r") as f:
+                base = json.load(f)
+        except (IOError, ValueError):
+            base = HttpClient(job_server).call('/agent/env/%s/%s' %
+                                               (ref['session'],
+                                                ref['version']))
+            if env_version(base) != ref['version']:
+                raise Exception("Received the wrong environment")
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+            tmp_fname = "%s.tmp.%d" % (fname, os.getpid())
+            with open(tmp_fname, "w") as f:
+                json.dump(base, f)
+            os.rename(tmp_fname, fname)
+        return Environment.deserialize(
+            apply_env_delta(base, run_info.get('env_delta', {})))
+
     @classmethod
     def run(cls, job_server, session_id, info):
         session = Session.load(session_id)
 
-        recipe_fname = os.path.join(session.path, 'build.py')
-        with open(recipe_fname, 'w') as f:
-            f.write(info['recipe'])
+        recipe_ref, recipe_fname, code = Bootstrap.load_recipe(job_server,
+                                                               info)
 
         run_info = info['run_info']
-        env = run_info.get('env')
-        if env:
-            env = Environment.deserialize(env)
-        else:
+        env = Bootstrap.load_env(job_server, run_info)
+        if not env:
             env = Bootstrap.create_env(info['parameters'], info['build_uuid'],
                                        info['build_name'])
 
         mod = imp.new_module('recipe')
         mod.__file__ = recipe_fname
-        execfile(recipe_fname, mod.__dict__)
+        exec code in mod.__dict__
 
         build = Bootstrap._find_build(mod)
         build.jobserver = job_server
+        build.recipe_ref = recipe_ref
         entrypoint = Bootstrap._find_entrypoint(build, run_info.get('step_fun'))
 
         args = run_info.get('args', [])
         kwargs = run_info.get('kwargs', {})
         ss_url = info['ss_url']
-        ret = build._start(env, session, entrypoint, args, kwargs, ss_url)
+        if 'spawn_time' in info:
+            # From the slave starting the job until the recipe runs
+            startup = time.time() - info['spawn_time']
+            session.startup_time = int(startup * 1000)
+            session.save()
+            print("Job started in %d ms" % session.startup_time)
+        try:
+            ret = build._start(env, session, entrypoint, args, kwargs, ss_url)
+        finally:
+            build._stop()
 
         # Update the session
         session = Session.load(session.id)
@@ -8,18 +8,33 @@
     :license: Apache License 2.0
 """
 from optparse import OptionParser
-import re, os, time, sys, types, subprocess, logging
-from .environment import Environment
+import os, time, sys, types, subprocess, logging, itertools, threading
+import signal, errno, json
+import tempfile, shutil
+from multiprocessing import cpu_count
+from .environment import Environment, env_version, env_delta
 from .artifacts import Artifacts
+from .cache import ArtifactCache
+from .workspace import WorkspacePool
+from .template import render, MissingVariable
+from .step_cache import StepCache, DEFAULT_TTL
 from .session import Session
 from .bootstrap import Bootstrap
-from .http_client import HttpClient
+from .http_client import HttpClient, HttpError
+from .timeline import Timeline, fetch_slog
 from .slog import (StepBegun, StepDone, StepJoinBegun, StepJoinDone,
                    JobBegun, JobDone, JobErrorThrown, SetDescription,
-                   SetBuildId, AsyncJoined)
+                   SetBuildId, AsyncStarted, AsyncJoined, CommandDone,
+                   SlogWriter)
 
 
-re_var = re.compile("{{(.*?)}}")
+# How long the job server may hold a request for async results
+LONG_POLL_TIMEOUT = 30
+# Polling intervals used when the job server can't long-poll
+POLL_MIN_INTERVAL = 0.05
+POLL_MAX_INTERVAL = 2.0
+# How long a timed out command gets to exit before it's killed
+KILL_GRACE_TIME = 10
 
 
 class BuildException(Exception):
@@ -37,40 +52,178 @@ class BuildFunction(object):
         return self.fun(*args, **kwargs)
 
 
+class StepOutput(object):
+    """Stands in for sys.stdout and sys.stderr while steps run
+       concurrently. Every thread writes to a file of its own, that is
+       appended to the log in one piece when its step is done, so the
+       steps' outputs don't interleave. The StepBegun and StepDone items
+       of the steps that run in the thread, nested ones included, are
+       held until then, as that is when their offsets are known."""
+    def __init__(self, real, lock, local):
+        self.real = real
+        self.lock = lock
+        self.local = local
+
+    def _file(self):
+        return getattr(self.local, 'f', None) or self.real
+
+    def write(self, data):
+        self._file().write(data)
+
+    def writelines(self, lines):
+        self._file().writelines(lines)
+
+    def flush(self):
+        self._file().flush()
+
+    def fileno(self):
+        return self._file().fileno()
+
+    def tell(self):
+        return self.real.tell()
+
+    def buffered(self):
+        return getattr(self.local, 'f', None) is not None
+
+    def position(self):
+        """Returns how much has been written to the thread's file"""
+        self.local.f.flush()
+        return self.local.f.tell()
+
+    def hold(self, item):
+        """Keeps a log item, with offsets in the thread's file, until
+           the file is committed"""
+        item.stamp()
+        self.local.items.append(item)
+
+    def commit(self):
+        """Appends the thread's output to the log. Returns the items that
+           were held, with their offsets now in the log."""
+        f = self.local.f
+        f.flush()
+        f.seek(0)
+        with self.lock:
+            self.real.flush()
+            start = self.real.tell()
+            shutil.copyfileobj(f, self.real)
+            self.real.flush()
+        f.seek(0)
+        f.truncate()
+        items, self.local.items = self.local.items, []
+        for item in items:
+            for key in ('log_start', 'log_end'):
+                if key in item.params:
+                    item.params[key] += start
+        return items
+
+
 class Step(BuildFunction):
-    def __init__(self, job, name, fun, **kwargs):
+    def __init__(self, job, name, fun, cache = None, after = [], **kwargs):
         BuildFunction.__init__(self, name, fun, **kwargs)
         self.job = job
         self._is_async = False
+        self.after = list(after)
+        if cache is True:
+            cache = {}
+        self.cache = cache
+
+    def _cache_key(self, args, kwargs):
+        """Returns None if the arguments can't be part of a key - the
+           step isn't cached then"""
+        env = dict((k, self.job.env.get(k)) for k in self.cache.get('env', []))
+        try:
+            return StepCache.key(self.name, args, kwargs, env,
+                                 self.job.recipe_ref)
+        except (TypeError, ValueError), e:
+            print("Warning: not caching '%s' - its arguments can't be "
+                  "stored (%s)" % (self.name, e))
+            return None
+
+    def _restore(self, entry):
+        """Fetches the artifacts of a cached step into the workspace, and
+           adds them to this build. Returns False if they are gone."""
+        try:
+            for remote_filename, local_filename in entry['artifacts']:
+                self.job.artifacts.get(remote_filename,
+                                       os.path.join(self.job.session.workspace,
+                                                    local_filename),
+                                       build_uuid = entry['build_uuid'])
+        except HttpError:
+            return False
+        for remote_filename, local_filename in entry['artifacts']:
+            self.job.artifacts.add(local_filename, remote_filename)
+        return True
+
+    def _store(self, key, ret, first_artifact):
+        artifacts = self.job.artifacts.added[first_artifact:]
+        added = set(local for remote, local in artifacts)
+        for output in self.cache.get('outputs', []):
+            output = self.job.format(output)
+            if output not in added:
+                self.job.artifacts.add(output)
+                artifacts.append(self.job.artifacts.added[-1])
+        self.job.step_cache.store(key, {'value': ret,
+                                        'build_uuid': self.job.build_uuid,
+                                        'artifacts': artifacts},
+                                  self.cache.get('ttl', DEFAULT_TTL))
 
     def __call__(self, *args, **kwargs):
-        sys.stdout.flush()
-        sys.stderr.flush()
-        log_start = sys.stdout.tell()
         if self._is_async and not self._is_entrypoint:
             ajob = AsyncJob(self.job, self, args, kwargs)
             ajob.run()
             self.job._async_jobs.append(ajob)
             return ajob
-        self.job.slog(StepBegun(self.name, args, kwargs, log_start))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # In schedule(), the output is buffered until the step that was
+        # scheduled is done
+        output = None
+        if isinstance(sys.stdout, StepOutput) and sys.stdout.buffered():
+            output = sys.stdout
+            log_start = output.position()
+            output.hold(StepBegun(self.name, args, kwargs, log_start))
+        else:
+            log_start = sys.stdout.tell()
+            self.job.slog(StepBegun(self.name, args, kwargs, log_start),
+                          flush = True)
         time_start = time.time()
         self.job._current_step = self
         self.job._print_banner("Step: '%s'" % self.name)
-        ret = self.fun(*args, **kwargs)
-
-        # Wait for any unfinished detached jobs
-        if self.job.has_running_asyncs():
-            diff = (time.time() - time_start) * 1000
-            self.job.slog(StepJoinBegun(self.name, diff))
-            self.job.join_asyncs()
-            diff = (time.time() - time_start) * 1000
-            self.job.slog(StepJoinDone(self.name, diff))
+        cached = False
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(args, kwargs)
+        if key is not None:
+            entry = self.job.step_cache.lookup(key)
+            if entry and self._restore(entry):
+                print("Using the cached result of '%s'" % self.name)
+                ret = entry['value']
+                cached = True
+        if not cached:
+            first_artifact = len(self.job.artifacts.added)
+            ret = self.fun(*args, **kwargs)
+
+            # Wait for any unfinished detached jobs
+            if self.job.has_running_asyncs():
+                diff = (time.time() - time_start) * 1000
+                self.job.slog(StepJoinBegun(self.name, diff))
+                self.job.join_asyncs()
+                diff = (time.time() - time_start) * 1000
+                self.job.slog(StepJoinDone(self.name, diff))
+
+            if key is not None:
+                self._store(key, ret, first_artifact)
 
         diff = (time.time() - time_start) * 1000
         sys.stdout.flush()
         sys.stderr.flush()
-        log_end = sys.stdout.tell()
-        self.job.slog(StepDone(self.name, diff, log_start, log_end))
+        if output:
+            output.hold(StepDone(self.name, diff, log_start,
+                                 output.position(), cached))
+        else:
+            log_end = sys.stdout.tell()
+            self.job.slog(StepDone(self.name, diff, log_start, log_end,
+                                   cached), flush = True)
         return ret
 
 
@@ -90,46 +243,94 @@ class AsyncJob(object):
         self.kwargs = kwargs
         self.state = STATE_PREPARED
         self.session_id = None
+        self.output = None
         self.result = None
-
-    def run(self):
-        data = {'build_id': self.job.build_uuid,
+        self.group = None
+
+    def dispatch_data(self, env = None):
+        if env is None:
+            env = self.job._dispatch_env()
+        run_info = {'step_fun': self.step.fun.__name__,
+                    'step_name': self.step.name,
+                    'args': self.args,
+                    'kwargs': self.kwargs}
+        run_info.update(env)
+        return {'build_id': self.job.build_uuid,
                 'job_server': self.job.jobserver,
                 'labels': [],
                 'parent': self.job.session.id,
-                'run_info': {'step_fun': self.step.fun.__name__,
-                             'step_name': self.step.name,
-                             'args': self.args,
-                             'kwargs': self.kwargs,
-                             'env': self.job.env.serialize()}}
-        self.ts_start = time.time()
-        js = HttpClient(self.job.jobserver)
-        res = js.call('/agent/dispatch', input = data)
-        self.session_id = res['session_id']
+                'run_info': run_info}
+
+    def started(self, session_id):
+        self.session_id = session_id
         self.state = STATE_RUNNING
+        self.job.slog(AsyncStarted(self.step.name, session_id))
 
-    def get(self):
-        if self.state == STATE_DONE:
-            return self.output
-        assert(self.state == STATE_RUNNING)
-        js = HttpClient(self.job.jobserver)
-        while True:
-            res = js.call('/agent/result/%s' % self.session_id)
-            if 'result' in res:
-                self.output = res['output']
-                self.result = res['result']
-                break
-            time.sleep(1)
+    def run(self):
+        self.ts_start = time.time()
+        res = self.job.js.call('/agent/dispatch', input = self.dispatch_data())
+        self.started(res['session_id'])
+
+    def done(self, res):
+        self.output = res['output']
+        self.result = res['result']
         self.state = STATE_DONE
         session_no = self.session_id.split('-')[-1]
         diff = (time.time() - self.ts_start) * 1000
         self.job.slog(AsyncJoined(session_no, diff))
+
+    def get(self):
+        if self.state != STATE_DONE:
+            self.job.wait_asyncs([self])
         return self.output
 
 
+class AsyncResults(object):
+    """A group of async jobs started by Build.map or Build.matrix
+
+       At most `max_in_flight` of the jobs are running at a time. The
+       rest are queued here and dispatched as the earlier ones finish.
+       All jobs that can be started are sent in a single request."""
+    def __init__(self, job, ajobs, max_in_flight = None):
+        self.job = job
+        self.ajobs = ajobs
+        self.max_in_flight = max_in_flight
+        for ajob in ajobs:
+            ajob.group = self
+
+    def pump(self):
+        queued = [a for a in self.ajobs if a.state == STATE_PREPARED]
+        if self.max_in_flight:
+            running = len([a for a in self.ajobs if a.state == STATE_RUNNING])
+            queued = queued[:max(self.max_in_flight - running, 0)]
+        if queued:
+            self.job.dispatch_asyncs(queued)
+
+    def get(self):
+        """Waits for all jobs and returns their outputs, in order"""
+        self.job.wait_asyncs(self.ajobs)
+        return [a.output for a in self.ajobs]
+
+    def __len__(self):
+        return len(self.ajobs)
+
+    def __iter__(self):
+        return iter(self.ajobs)
+
+    def __getitem__(self, i):
+        return self.ajobs[i]
+
+
 class Build(object):
-    def __init__(self, import_name, debug = False):
+    def __init__(self, import_name, debug = False, workspace = None):
+        """`workspace` names a persistent workspace to build in, e.g.
+           "{{MANIFEST_URL}}:{{BRANCH}}". The previous session with the
+           same name left its files there. Without it, every session
+           starts with an empty workspace."""
         self._import_name = import_name
+        self.recipe_ref = None
+        self._workspace_key = workspace
+        self._workspace_lease = None
         # The session is known when running - not this early
         self._session = None
         self.steps = []
@@ -139,6 +340,9 @@ class Build(object):
         self.build_uuid = None
         self.debug = debug
         self._job_key = os.environ.get("SCI_JOB_KEY")
+        # The current step and its async jobs are per thread, as
+        # schedule() runs steps in threads of their own
+        self._local = threading.local()
         self._current_step = None
 
         self.env = Environment()
@@ -146,14 +350,172 @@ class Build(object):
         self.artifacts = None,
         self.jobserver = "http://localhost:6697"
         self._async_jobs = []
+        self._long_poll = True
+        self._bulk_dispatch = True
+        self._env_snapshots = True
+        self._env_base = None
+        self._slog_writer = None
+
+    def _get_current_step(self):
+        return getattr(self._local, 'current_step', None)
+
+    def _set_current_step(self, step):
+        self._local.current_step = step
+
+    _current_step = property(_get_current_step, _set_current_step)
+
+    def _get_async_jobs(self):
+        if not hasattr(self._local, 'async_jobs'):
+            self._local.async_jobs = []
+        return self._local.async_jobs
+
+    def _set_async_jobs(self, ajobs):
+        self._local.async_jobs = ajobs
+
+    _async_jobs = property(_get_async_jobs, _set_async_jobs)
 
     def has_running_asyncs(self):
-        njobs = len([a for a in self._async_jobs if a.state == STATE_RUNNING])
+        njobs = len([a for a in self._async_jobs if a.state != STATE_DONE])
         return njobs > 0
 
+    def _dispatch_env(self):
+        """Returns the environment to send to async jobs
+
+           That is a reference to a snapshot of the environment, that
+           is kept by the job server, and what has changed since then.
+           A new snapshot is stored when the changes grow large. Job
+           servers that don't keep snapshots get all of it."""
+        data = self.env.serialize()
+        if not self._env_snapshots:
+            return {'env': data}
+        if self._env_base:
+            version, base = self._env_base
+            delta = env_delta(base, data)
+            if len(json.dumps(delta)) * 2 < len(json.dumps(data)):
+                return {'env_ref': {'session': self.session.id,
+                                    'version': version},
+                        'env_delta': delta}
+        base = json.loads(json.dumps(data))
+        version = env_version(base)
+        try:
+            self.js.call('/agent/env/%s/%s' % (self.session.id, version),
+                         method = 'PUT', input = base)
+        except HttpError, e:
+            if e.code not in (404, 405, 501):
+                raise
+            self._env_snapshots = False
+            return {'env': data}
+        self._env_base = (version, base)
+        return {'env_ref': {'session': self.session.id, 'version': version},
+                'env_delta': {}}
+
+    def dispatch_asyncs(self, ajobs):
+        """Starts several async jobs using a single request"""
+        env = self._dispatch_env()
+        ts_start = time.time()
+        for ajob in ajobs:
+            ajob.ts_start = ts_start
+        if self._bulk_dispatch:
+            try:
+                data = [ajob.dispatch_data(env) for ajob in ajobs]
+                res = self.js.call('/agent/dispatch/bulk',
+                                   input = {'jobs': data})
+                for ajob, session_id in zip(ajobs, res['session_ids']):
+                    ajob.started(session_id)
+                return
+            except HttpError, e:
+                if e.code not in (404, 405):
+                    raise
+                self._bulk_dispatch = False
+        for ajob in ajobs:
+            res = self.js.call('/agent/dispatch',
+                               input = ajob.dispatch_data(env))
+            ajob.started(res['session_id'])
+
+    def map(self, step, iterable, max_in_flight = None):
+        """Runs an async step once for every item in `iterable`
+
+           Returns an AsyncResults, whose get() returns the outputs in
+           the same order as the items."""
+        return self._start_asyncs(step, [((item,), {}) for item in iterable],
+                                  max_in_flight)
+
+    def matrix(self, step, max_in_flight = None, **axes):
+        """Runs an async step once for every combination of the axes
+
+           build.matrix(run_single_job, product = ["a", "b"],
+                        variant = ["eng", "user"])
+
+           will call run_single_job(product = ..., variant = ...) four
+           times. Returns an AsyncResults."""
+        names = sorted(axes)
+        calls = [((), dict(zip(names, values))) for values in
+                 itertools.product(*[axes[name] for name in names])]
+        return self._start_asyncs(step, calls, max_in_flight)
+
+    def _start_asyncs(self, step, calls, max_in_flight):
+        if not getattr(step, '_is_async', False):
+            raise BuildException("Step '%s' is not asynchronous" % step.name)
+        ajobs = [AsyncJob(self, step, list(args), kwargs)
+                 for args, kwargs in calls]
+        results = AsyncResults(self, ajobs, max_in_flight)
+        results.pump()
+        self._async_jobs.extend(ajobs)
+        return results
+
+    def _poll_results(self, session_ids):
+        """Returns the results of the sessions that have finished
+
+           The job server holds the request until at least one of the
+           sessions has finished. Servers that don't support that are
+           asked about each session in turn instead."""
+        if self._long_poll:
+            try:
+                res = self.js.call('/agent/results',
+                                   input = {'session_ids': session_ids,
+                                            'timeout': LONG_POLL_TIMEOUT})
+                return res['results']
+            except HttpError, e:
+                if e.code not in (404, 405):
+                    raise
+                self._long_poll = False
+        results = {}
+        for session_id in session_ids:
+            res = self.js.call('/agent/result/%s' % session_id)
+            if 'result' in res:
+                results[session_id] = res
+        return results
+
+    def wait_asyncs(self, ajobs):
+        """Waits until all the given async jobs have finished"""
+        interval = POLL_MIN_INTERVAL
+        while True:
+            groups = set(a.group for a in ajobs if a.group)
+            for group in groups:
+                group.pump()
+            if all(a.state == STATE_DONE for a in ajobs):
+                return
+            # Jobs that a group holds back are dispatched as the others
+            # in the group finish, so wait for those too
+            waiting = set(ajobs)
+            for group in groups:
+                waiting.update(group.ajobs)
+            running = dict((a.session_id, a) for a in waiting
+                           if a.state == STATE_RUNNING)
+            if not running:
+                return
+            results = self._poll_results(running.keys())
+            for session_id in results:
+                if session_id in running:
+                    running[session_id].done(results[session_id])
+            if results or self._long_poll:
+                interval = POLL_MIN_INTERVAL
+                continue
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+
     def join_asyncs(self):
-        for ajob in self._async_jobs:
-            ajob.get()
+        self.wait_asyncs(self._async_jobs)
 
         # Return all the return values
         res = [a.output for a in self._async_jobs]
@@ -161,6 +523,102 @@ class Build(object):
         self._async_jobs = []
         return res
 
+    def schedule(self, *steps, **kwargs):
+        """Runs steps concurrently, as far as their dependencies allow
+
+           Every step runs after the steps in its `after` list, which
+           are run as well even if they aren't given here. At most
+           `max_workers` (default: the number of cores) steps run at a
+           time. Each step's output is kept together in the log, and
+           its StepDone has the offsets of where it ended up. Returns
+           the steps' return values, in the order given.
+
+           If a step fails, no more steps are started, and the error is
+           raised once the running ones have finished."""
+        max_workers = kwargs.get('max_workers') or cpu_count()
+        order = []
+        visiting = []
+
+        def visit(step):
+            if step in visiting:
+                cycle = visiting[visiting.index(step):] + [step]
+                raise BuildException("Steps depend on each other: %s" %
+                                     " -> ".join(s.name for s in cycle))
+            if step not in order:
+                visiting.append(step)
+                for dep in step.after:
+                    visit(dep)
+                visiting.pop()
+                order.append(step)
+        for step in steps:
+            visit(step)
+
+        cv = threading.Condition()
+        pending = list(order)
+        running = set()
+        done = set()
+        results = {}
+        errors = []
+        local = threading.local()
+        real_stdout, real_stderr = sys.stdout, sys.stderr
+        sys.stdout = StepOutput(real_stdout, threading.Lock(), local)
+        sys.stderr = StepOutput(real_stderr, sys.stdout.lock, local)
+
+        def run(step):
+            local.f = tempfile.TemporaryFile()
+            local.items = []
+            try:
+                try:
+                    results[step] = step()
+                finally:
+                    for item in sys.stdout.commit():
+                        self.slog(item, flush = True)
+            except:
+                errors.append(sys.exc_info())
+            finally:
+                local.f.close()
+                local.f = None
+                with cv:
+                    running.remove(step)
+                    done.add(step)
+                    cv.notify()
+
+        try:
+            with cv:
+                while pending or running:
+                    for step in list(pending):
+                        if errors or len(running) >= max_workers:
+                            break
+                        if all(dep in done for dep in step.after):
+                            pending.remove(step)
+                            running.add(step)
+                            t = threading.Thread(target = run, args = (step,))
+                            t.daemon = True
+                            t.start()
+                    if not running:
+                        break
+                    cv.wait()
+        finally:
+            sys.stdout, sys.stderr = real_stdout, real_stderr
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return [results[step] for step in steps]
+
+    def save_timeline(self, filename = "timeline.json"):
+        """Stores a timeline of this session, and of the async jobs it
+           has started, as an artifact
+
+           The file is in the Chrome trace event format, and can be
+           opened in chrome://tracing."""
+        if self._slog_writer:
+            self._slog_writer.flush()
+        timeline = Timeline.load(self.session.id,
+                                 lambda sid: fetch_slog(self.js, sid))
+        filename = self.format(filename)
+        with open(os.path.join(self.session.workspace, filename), "w") as f:
+            json.dump(timeline.trace(), f)
+        return self.artifacts.add(filename, description = "Build timeline")
+
     def set_description(self, description):
         self._description = self.format(description)
         self.slog(SetDescription(self._description))
@@ -180,6 +638,14 @@ class Build(object):
 
     build_id = property(get_build_id, set_build_id)
 
+    def set_jobserver(self, url):
+        self.js = HttpClient(url)
+
+    def get_jobserver(self):
+        return self.js.url
+
+    jobserver = property(get_jobserver, set_jobserver)
+
     def set_session(self, session):
         if self._session:
             raise BuildException("The session can only be set once")
@@ -205,6 +671,21 @@ class Build(object):
         return decorator
 
     def step(self, name, **kwargs):
+        """Declares a build step
+
+           With cache = {...}, the step's result is reused when it is
+           called again with the same arguments, in a build of the same
+           recipe on the same slave. The dict may contain:
+
+             env:     environment variables that the result depends on
+             outputs: files in the workspace that the step produces
+             ttl:     how long, in seconds, the result can be reused
+
+           The files, and any artifacts the step adds, are restored
+           from the artifact store. cache = True uses the defaults.
+
+           With after = [...], the step is run after the given steps
+           when it is run through schedule()."""
         def decorator(f):
             s = Step(self, name, f, **kwargs)
             self.steps.append(s)
@@ -246,9 +727,19 @@ class Build(object):
         # Must set time first. It's used when printing
         self.start_time = time.time()
         self.session = session
-        self.artifacts = Artifacts(self, ss_url)
+        cache = ArtifactCache(os.path.join(Session.root_path, "cache",
+                                           "artifacts"))
+        self.artifacts = Artifacts(self, ss_url, cache,
+                                   os.path.join(Session.root_path, "cache",
+                                                "sha1"))
+        self.step_cache = StepCache(os.path.join(Session.root_path, "cache",
+                                                 "steps"))
         self.build_uuid = env['SCI_BUILD_UUID']
         self.env = env
+        if self._workspace_key:
+            self._lease_workspace(self.format(self._workspace_key))
+        self._slog_writer = SlogWriter(self.js, session)
+        self._slog_writer.start()
 
         if entrypoint.is_main:
             for name in self._default_fns:
@@ -264,12 +755,42 @@ class Build(object):
         ret = entrypoint.fun(*args, **kwargs)
         self._print_banner("Job Finished", dash = "=")
         if entrypoint.is_main:
-            self.slog(JobDone())
+            self.slog(JobDone(), wait = True)
         return ret
 
-    def slog(self, item):
-        url = '/slog/%s' % self.session.id
-        HttpClient(self.jobserver).call(url, input = item.serialize(), raw = True)
+    def _lease_workspace(self, key):
+        pool = WorkspacePool(os.path.join(Session.root_path, "workspaces"))
+        lease = pool.lease(key)
+        if not lease:
+            print("All workspaces for '%s' are in use - using a new one" % key)
+            return
+        # Let the session's workspace point at the persistent one
+        os.rmdir(self.session.workspace)
+        os.symlink(lease.path, self.session.workspace)
+        self._workspace_lease = lease
+        print("Using workspace %s for '%s'" % (lease.path, key))
+
+    def _stop(self):
+        if self._slog_writer:
+            self._slog_writer.close()
+            self._slog_writer = None
+        if self._workspace_lease:
+            self._workspace_lease.release()
+            self._workspace_lease = None
+
+    def slog(self, item, flush = False, wait = False):
+        """Queues a log item for the job server
+
+           With `flush`, the pending items are sent right away instead
+           of waiting for a full batch. With `wait`, this call also
+           blocks until they have been sent (or spooled)."""
+        if not self._slog_writer:
+            url = '/slog/%s' % self.session.id
+            self.js.call(url, input = item.serialize(), raw = True)
+            return
+        self._slog_writer.put(item, flush = flush or wait)
+        if wait:
+            self._slog_writer.flush()
 
     def start(self, params = {}):
         """Start a build manually (for testing)
@@ -277,7 +798,7 @@ class Build(object):
            This method is only used when running a build manually by
            invoking the build script from the command line."""
         logging.basicConfig(level=logging.DEBUG)
-        client = HttpClient(self.jobserver)
+        client = self.js
 
         # The build will contain all information necessary to build it,
         # also including parameters. Gather all those
@@ -313,48 +834,99 @@ class Build(object):
                              'output': res})
         return res
 
-    def run(self, cmd, **kwargs):
+    def run(self, cmd, timeout = None, capture = False, **kwargs):
         """Runs a command in a shell
 
            The command will be run with the current working directory
            set to be the session's workspace.
 
+           If the command hasn't finished within `timeout` seconds, it
+           is terminated together with any processes it has started.
+           With capture = True, the command's output is returned, as
+           well as written to the log.
+
            If the command fails, this method will raise an error
         """
         sys.stdout.flush()
         cmd = self.format(cmd, **kwargs)
         devnull = open("/dev/null", "r")
+        time_start = time.time()
         p = subprocess.Popen(cmd,
                              shell = True,
                              executable = '/bin/bash',
-                             stdin = devnull, stdout = sys.stdout,
+                             stdin = devnull,
+                             stdout = subprocess.PIPE if capture else sys.stdout,
                              stderr = sys.stderr,
-                             cwd = self.session.workspace)
-        p.communicate()
+                             cwd = self.session.workspace,
+                             preexec_fn = os.setsid)
+        devnull.close()
+        done = threading.Event()
+        timed_out = []
+        killer = None
+        if timeout is not None:
+            killer = threading.Thread(target = self._kill_command,
+                                      args = (p.pid, timeout, done, timed_out))
+            killer.daemon = True
+            killer.start()
+        output = []
+        if capture:
+            for line in iter(p.stdout.readline, ''):
+                sys.stdout.write(line)
+                output.append(line)
+            p.stdout.close()
+        while True:
+            try:
+                _, status, rusage = os.wait4(p.pid, 0)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        done.set()
+        if killer:
+            killer.join()
+        # Reaped above, so that Popen doesn't try to wait for it
+        p.returncode = (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+                        else os.WEXITSTATUS(status))
         sys.stdout.flush()
+        self.slog(CommandDone(cmd, p.returncode,
+                              (time.time() - time_start) * 1000,
+                              rusage.ru_utime * 1000, rusage.ru_stime * 1000,
+                              rusage.ru_maxrss, bool(timed_out)))
+        if timed_out:
+            self.error("External command timed out after %s seconds: %s" %
+                       (timeout, cmd))
         if p.returncode != 0:
             self.error("External command returned result code %d: %s" %
                        (p.returncode, cmd))
-
-    def _format(self, tmpl, **kwargs):
-        while True:
-            m = re_var.search(tmpl)
-            if not m:
-                break
-            name = m.groups()[0]
-            value = self.var(name, **kwargs)
-            if not value:
-                self.error("Failed to replace template variable %s" % name)
-            tmpl = tmpl.replace("{{%s}}" % name, str(value))
-        return tmpl
+        if capture:
+            return ''.join(output)
+
+    def _kill_command(self, pgid, timeout, done, timed_out):
+        """Terminates the process group of a command that runs for too
+           long, and kills whatever is left of it after a grace period
+           or once the command has exited"""
+        if done.wait(timeout):
+            return
+        timed_out.append(True)
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(pgid, sig)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+                return
+            done.wait(KILL_GRACE_TIME)
 
     def format(self, tmpl, **kwargs):
-        if isinstance(tmpl, basestring):
-            return self._format(tmpl, **kwargs)
-        elif isinstance(tmpl, types.ListType):
-            return [self._format(t, **kwargs) for t in tmpl]
-        else:
-            raise TypeError("Invalid type for format")
+        lookup = lambda name: self.var(name, **kwargs)
+        try:
+            if isinstance(tmpl, basestring):
+                return render(tmpl, lookup)
+            elif isinstance(tmpl, types.ListType):
+                return [render(t, lookup) for t in tmpl]
+        except MissingVariable, e:
+            self.error(str(e))
+        raise TypeError("Invalid type for format")
 
     def var(self, _key, **kwargs):
         value = kwargs.get(_key)
@@ -363,5 +935,5 @@ class Build(object):
         return value
 
     def error(self, what):
-        self.slog(JobErrorThrown(what))
+        self.slog(JobErrorThrown(what), wait = True)
         raise BuildException(what)
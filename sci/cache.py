@@ -0,0 +1,145 @@
+"""
+    sci.cache
+    ~~~~~~~~~
+
+    Node-local Artifact Cache
+
+    Artifacts that are downloaded by one session are kept in a cache
+    shared by all sessions on the same slave, so that they only have
+    to be fetched once per node.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, errno, fcntl, hashlib, shutil
+
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+
+class ArtifactCache(object):
+    """A content cache keyed by (build uuid, filename, validator)
+
+       Only one process downloads a missing entry - the others wait
+       for it to finish and then use the result. Hits are hard-linked
+       into the workspace when possible. The least recently used
+       entries are removed when the cache grows beyond `max_size`."""
+    def __init__(self, path, max_size = DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+    def _entry(self, key):
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.path, digest)
+
+    def _lock(self, entry, blocking = True):
+        """Locks an entry and returns the open lock file, or None if it
+           is locked and `blocking` is false"""
+        while True:
+            lock = open(entry + ".lock", "a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX |
+                            (0 if blocking else fcntl.LOCK_NB))
+            except IOError:
+                lock.close()
+                return None
+            # The entry may have been evicted, and its lock file removed,
+            # while we were waiting for it
+            try:
+                if os.stat(entry + ".lock").st_ino == \
+                        os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except OSError:
+                pass
+            lock.close()
+
+    def _fill(self, entry, download):
+        with self._lock(entry) as lock:
+            try:
+                if os.path.exists(entry):
+                    # Someone else downloaded it while we were waiting
+                    return
+                tmp_filename = "%s.tmp.%d" % (entry, os.getpid())
+                try:
+                    download(tmp_filename)
+                    os.chmod(tmp_filename, 0444)
+                    os.rename(tmp_filename, entry)
+                finally:
+                    if os.path.exists(tmp_filename):
+                        os.remove(tmp_filename)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.evict(keep = entry)
+
+    def _place(self, entry, local_filename):
+        if os.path.lexists(local_filename):
+            os.remove(local_filename)
+        try:
+            os.link(entry, local_filename)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                raise
+            # Probably on another file system
+            shutil.copyfile(entry, local_filename)
+
+    def fetch(self, key, local_filename, download):
+        """Puts the cached file for `key` at `local_filename`
+
+           If it isn't cached, download(filename) is called first to
+           store it at the given filename."""
+        entry = self._entry(key)
+        for attempt in range(2):
+            if os.path.exists(entry):
+                # Mark it as recently used
+                os.utime(entry, None)
+            else:
+                self._fill(entry, download)
+            try:
+                self._place(entry, local_filename)
+                return
+            except OSError, e:
+                # Evicted between the fill and the link - once more
+                if e.errno != errno.ENOENT or attempt > 0:
+                    raise
+
+    def evict(self, keep = None):
+        """Removes the least recently used entries until the cache fits"""
+        with open(os.path.join(self.path, "evict.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Someone else is already evicting
+                return
+            entries = []
+            total = 0
+            for name in os.listdir(self.path):
+                if "." in name:
+                    continue
+                fname = os.path.join(self.path, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, fname in entries:
+                if total <= self.max_size:
+                    break
+                if fname == keep:
+                    continue
+                entry_lock = self._lock(fname, blocking = False)
+                if not entry_lock:
+                    # Being downloaded
+                    continue
+                try:
+                    os.remove(fname)
+                    os.remove(fname + ".lock")
+                except OSError:
+                    pass
+                finally:
+                    entry_lock.close()
+                total -= size
@@ -7,7 +7,37 @@
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
-import types
+import types, json, hashlib
+
+
+def env_version(data):
+    """Returns the version of a serialized environment, which is a
+       digest of its contents"""
+    return hashlib.sha1(json.dumps(data, sort_keys = True)).hexdigest()
+
+
+def env_delta(base, data):
+    """Returns how the serialized environment `data` differs from `base`"""
+    delta = {}
+    for part in ("v", "c"):
+        changed = dict((k, v) for k, v in data[part].items()
+                       if k not in base[part] or base[part][k] != v)
+        removed = [k for k in base[part] if k not in data[part]]
+        if changed:
+            delta[part] = changed
+        if removed:
+            delta[part + "-"] = removed
+    return delta
+
+
+def apply_env_delta(base, delta):
+    """Returns the serialized environment that `delta` was made from"""
+    data = {"v": dict(base["v"]), "c": dict(base["c"])}
+    for part in ("v", "c"):
+        data[part].update(delta.get(part, {}))
+        for k in delta.get(part + "-", []):
+            data[part].pop(k, None)
+    return data
 
 
 class Environment(dict):
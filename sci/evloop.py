@@ -0,0 +1,442 @@
+"""
+    sci.evloop
+    ~~~~~~~~~~
+
+    Event Loop
+
+    A single-threaded loop over poll(), with timers, signal handling
+    through a self-pipe, and just enough HTTP - a server for the
+    agent's own endpoints and a client for the job and storage
+    servers - to never block on the network.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, collections, errno, fcntl, heapq, itertools, json, select
+import signal, socket, threading, time, traceback, types, urllib, urlparse
+from .http_client import HttpError, APIEncoder
+
+HTTP_TIMEOUT = 60
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+SEND_SIZE = 256 * 1024
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found",
+               405: "Method Not Allowed", 412: "Precondition Failed",
+               500: "Internal Server Error"}
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Timer(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.callback = None
+
+
+class EventLoop(object):
+    def __init__(self):
+        self.poll = select.poll()
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.seq = itertools.count()
+        self.running = False
+        self.signal_handlers = {}
+        # Callbacks from other threads
+        self.pending = collections.deque()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        _set_nonblocking(self.wakeup_r)
+        _set_nonblocking(self.wakeup_w)
+        self.add_reader(self.wakeup_r, self._read_signals)
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.seq), timer))
+        return timer
+
+    def _update(self, fd):
+        mask = 0
+        if fd in self.readers:
+            mask |= select.POLLIN
+        if fd in self.writers:
+            mask |= select.POLLOUT
+        if mask:
+            self.poll.register(fd, mask)
+        else:
+            try:
+                self.poll.unregister(fd)
+            except KeyError:
+                pass
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+        self._update(fd)
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+        self._update(fd)
+
+    def add_signal_handler(self, signum, callback):
+        """Runs callback() from the loop when the signal arrives"""
+        self.signal_handlers[signum] = callback
+        signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._wakeup(chr(signum))
+
+    def _wakeup(self, byte):
+        try:
+            os.write(self.wakeup_w, byte)
+        except OSError:
+            # The pipe is full, so the loop is about to wake up anyway
+            pass
+
+    def call_from_thread(self, callback, *args):
+        """Runs callback(*args) from the loop. Unlike the rest of the
+           loop, this can be called from any thread."""
+        self.pending.append((callback, args))
+        self._wakeup(chr(0))
+
+    def run_in_thread(self, fn, callback, *args):
+        """Runs fn(*args) in a thread of its own, for what would block
+           the loop, and then callback(result, error) from the loop"""
+        def run():
+            try:
+                result = fn(*args)
+            except Exception, e:
+                traceback.print_exc()
+                self.call_from_thread(callback, None, e)
+                return
+            self.call_from_thread(callback, result, None)
+        t = threading.Thread(target = run)
+        t.daemon = True
+        t.start()
+
+    def _read_signals(self):
+        try:
+            data = os.read(self.wakeup_r, 4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return
+        for signum in set(ord(c) for c in data):
+            if signum in self.signal_handlers:
+                self.signal_handlers[signum]()
+        while self.pending:
+            callback, args = self.pending.popleft()
+            self._run_callback(callback, *args)
+
+    def stop(self):
+        self.running = False
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            while self.timers and self.timers[0][2].callback is None:
+                heapq.heappop(self.timers)
+            timeout = -1
+            if self.timers:
+                timeout = max(0, (self.timers[0][0] - time.time()) * 1000)
+            try:
+                events = self.poll.poll(timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            for fd, mask in events:
+                if mask & (select.POLLIN | select.POLLHUP | select.POLLERR) \
+                        and fd in self.readers:
+                    self._run_callback(self.readers[fd])
+                if mask & (select.POLLOUT | select.POLLHUP | select.POLLERR) \
+                        and fd in self.writers:
+                    self._run_callback(self.writers[fd])
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                timer = heapq.heappop(self.timers)[2]
+                if timer.callback:
+                    self._run_callback(timer.callback, *timer.args)
+
+
+class _Stream(object):
+    """A non-blocking socket that is read until `done` says so"""
+    def __init__(self, loop, sock):
+        self.loop = loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbuf = ""
+        # Chunks to send, and how much of the first one has been sent
+        self.outbuf = collections.deque()
+        self.outpos = 0
+        # (file, bytes left) to send after the chunks
+        self.source = None
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if data:
+            self.outbuf.append(data)
+        self.loop.add_writer(self.fd, self._on_writable)
+
+    def write_file(self, f, size):
+        """Sends `size` bytes from `f`, a piece at a time, after what
+           has been written. The file is closed when done."""
+        self.source = (f, size)
+        self.loop.add_writer(self.fd, self._on_writable)
+
+    def _close_source(self):
+        if self.source:
+            self.source[0].close()
+            self.source = None
+
+    def _on_writable(self):
+        if not self.outbuf and self.source:
+            f, left = self.source
+            data = f.read(min(left, SEND_SIZE))
+            if data:
+                self.outbuf.append(data)
+                self.source = (f, left - len(data))
+            if not data or len(data) == left:
+                self._close_source()
+        if self.outbuf:
+            chunk = self.outbuf[0]
+            try:
+                n = self.sock.send(buffer(chunk, self.outpos, SEND_SIZE))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                return self.failed(e)
+            self.outpos += n
+            if self.outpos == len(chunk):
+                self.outbuf.popleft()
+                self.outpos = 0
+        if not self.outbuf and not self.source:
+            self.loop.remove_writer(self.fd)
+            self.written()
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(256 * 1024)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            return self.failed(e)
+        self.inbuf += data
+        self.received(not data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._close_source()
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.sock.close()
+
+    def written(self):
+        pass
+
+    def received(self, eof):
+        pass
+
+    def failed(self, error):
+        self.close()
+
+
+def _parse_head(data):
+    """Returns (first line, headers) of an HTTP message head"""
+    lines = data.split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return lines[0], headers
+
+
+class _ServerConnection(_Stream):
+    def __init__(self, loop, sock, handler):
+        _Stream.__init__(self, loop, sock)
+        self.handler = handler
+        self.timer = loop.call_later(HTTP_TIMEOUT, self.close)
+        loop.add_reader(self.fd, self._on_readable)
+
+    def received(self, eof):
+        head_end = self.inbuf.find("\r\n\r\n")
+        if head_end < 0:
+            if eof or len(self.inbuf) > MAX_REQUEST_SIZE:
+                self.close()
+            return
+        request_line, headers = _parse_head(self.inbuf[:head_end])
+        length = int(headers.get("content-length", 0))
+        body = self.inbuf[head_end + 4:]
+        if len(body) < length and not eof:
+            if length > MAX_REQUEST_SIZE:
+                self.close()
+            return
+        self.loop.remove_reader(self.fd)
+        try:
+            method, path = request_line.split()[:2]
+            status, content_type, data = self.handler(method, path,
+                                                      body[:length])
+        except Exception:
+            traceback.print_exc()
+            status, content_type, data = 500, "text/plain", "Error"
+        self.write("HTTP/1.0 %d %s\r\nContent-Type: %s\r\n"
+                   "Content-Length: %d\r\nConnection: close\r\n\r\n%s" %
+                   (status, STATUS_TEXT.get(status, ""), content_type,
+                    len(data), data))
+
+    def written(self):
+        self.close()
+
+    def close(self):
+        self.timer.cancel()
+        _Stream.close(self)
+
+
+class HttpServer(object):
+    """Serves handler(method, path, body) -> (status, content type, data),
+       one request per connection"""
+    def __init__(self, loop, address, handler):
+        self.loop = loop
+        self.handler = handler
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(128)
+        self.sock.setblocking(0)
+        loop.add_reader(self.sock.fileno(), self._accept)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR,
+                                 errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(0)
+            _ServerConnection(self.loop, sock, self.handler)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class _ClientRequest(_Stream):
+    def __init__(self, loop, host, port, request, raw, callback, timeout,
+                 body_file = None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        _Stream.__init__(self, loop, sock)
+        self.raw = raw
+        self.callback = callback
+        self.timer = loop.call_later(timeout, self.failed,
+                                     socket.timeout("timed out"))
+        err = sock.connect_ex((host, port))
+        if err not in (0, errno.EINPROGRESS):
+            loop.call_later(0, self.failed, socket.error(err,
+                                                         os.strerror(err)))
+            if body_file:
+                body_file[0].close()
+            return
+        self.write(request)
+        if body_file:
+            self.write_file(*body_file)
+
+    def _on_writable(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            return self.failed(socket.error(err, os.strerror(err)))
+        _Stream._on_writable(self)
+
+    def written(self):
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def received(self, eof):
+        if not eof:
+            return
+        head_end = self.inbuf.find("\r\n\r\n")
+        if head_end < 0:
+            return self.failed(socket.error("Incomplete reply"))
+        status_line, headers = _parse_head(self.inbuf[:head_end])
+        body = self.inbuf[head_end + 4:]
+        self.close()
+        try:
+            status = int(status_line.split()[1])
+            if status < 200 or status > 299:
+                raise HttpError(status)
+            result = body if self.raw else json.loads(body)
+        except Exception, e:
+            return self._done(None, e)
+        self._done(result, None)
+
+    def failed(self, error):
+        self.close()
+        self._done(None, error)
+
+    def _done(self, result, error):
+        if self.callback:
+            callback, self.callback = self.callback, None
+            self.loop._run_callback(callback, result, error)
+
+    def close(self):
+        self.timer.cancel()
+        _Stream.close(self)
+
+
+def http_call(loop, url, path, callback, method = None, input = None,
+              raw = False, timeout = HTTP_TIMEOUT, input_file = None,
+              **kwargs):
+    """Like HttpClient.call, but returns at once. callback(result,
+       error) is called from the loop, with either the reply or the
+       exception (HttpError if the status wasn't 2xx).
+
+       With `input_file`, the body is the contents of that file, that
+       are read as they are sent."""
+    body_file = None
+    if input_file:
+        f = open(input_file, "rb")
+        body_file = (f, os.fstat(f.fileno()).st_size)
+    if not method:
+        method = "POST" if input is not None or body_file else "GET"
+    headers = {"Accept": "application/json, text/plain, */*",
+               "Connection": "close"}
+    if type(input) is types.DictType:
+        headers['Content-type'] = 'application/json'
+        input = json.dumps(input, cls=APIEncoder)
+    input = input or ""
+    if isinstance(input, unicode):
+        input = input.encode("utf-8")
+    u = urlparse.urlparse(url + path)
+    target = u.path
+    if kwargs:
+        target += "?" + urllib.urlencode(kwargs)
+    headers["Host"] = u.netloc
+    headers["Content-Length"] = str(body_file[1] if body_file else len(input))
+    request = "%s %s HTTP/1.0\r\n%s\r\n\r\n%s" % (
+        method, target,
+        "\r\n".join("%s: %s" % kv for kv in headers.items()), input)
+    _ClientRequest(loop, u.hostname, u.port or 80, request, raw, callback,
+                   timeout, body_file)
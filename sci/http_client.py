@@ -4,10 +4,18 @@
 
     SCI HTTP Client
 
+    Connections are kept alive and shared between all clients talking
+    to the same host, so that consecutive calls don't have to pay for
+    setting up a new TCP connection each time.
+
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
-import urlparse, httplib, json, urllib, datetime, types
+import urlparse, httplib, json, urllib, datetime, types, socket, threading
+import time
+
+IDLE_TIMEOUT = 30
+MAX_IDLE_PER_HOST = 8
 
 
 class APIEncoder(json.JSONEncoder):
@@ -24,12 +32,82 @@ class HttpError(Exception):
         self.code = code
 
 
+class Connection(httplib.HTTPConnection):
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        # httplib sends the headers and a streamed body in separate
+        # writes, which would otherwise stall on Nagle's algorithm
+        # when the connection is kept alive.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of persistent HTTP/1.1 connections per host
+
+       Connections that have been idle for longer than `idle_timeout`
+       are closed rather than reused, as the server has most likely
+       dropped them already."""
+    def __init__(self, idle_timeout = IDLE_TIMEOUT,
+                 max_idle = MAX_IDLE_PER_HOST):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, host, port):
+        """Returns (connection, reused)"""
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get((host, port), [])
+            while conns:
+                c, last_used = conns.pop()
+                if last_used + self.idle_timeout > now:
+                    return c, True
+                c.close()
+        return Connection(host, port), False
+
+    def put(self, host, port, c):
+        with self.lock:
+            conns = self.idle.setdefault((host, port), [])
+            if len(conns) < self.max_idle:
+                conns.append((c, time.time()))
+                return
+        c.close()
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            for key, conns in self.idle.items():
+                keep = []
+                for c, last_used in conns:
+                    if last_used + self.idle_timeout > now:
+                        keep.append((c, last_used))
+                    else:
+                        c.close()
+                self.idle[key] = keep
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for c, last_used in conns:
+                    c.close()
+            self.idle = {}
+
+
+pool = ConnectionPool()
+
+
 class HttpClient(object):
-    def __init__(self, url):
+    def __init__(self, url, pool = pool):
         self.url = url
+        self.pool = pool
+
+    def request(self, path, method = None, input = None, **kwargs):
+        return HttpRequest(self.url, path, method, input, pool = self.pool,
+                           **kwargs)
 
     def call(self, path, method = None, input = None, raw = False, **kwargs):
-        with HttpRequest(self.url, path, method, input, **kwargs) as f:
+        with self.request(path, method, input, **kwargs) as f:
             data = f.read()
             if raw:
                 return data
@@ -37,7 +115,8 @@ class HttpClient(object):
 
 
 class HttpRequest(object):
-    def __init__(self, url, path, method = None, input = None, **kwargs):
+    def __init__(self, url, path, method = None, input = None, pool = pool,
+                 **kwargs):
         if not method:
             method = "POST" if input else "GET"
         headers = {"Accept": "application/json, text/plain, */*"}
@@ -45,14 +124,37 @@ class HttpRequest(object):
             headers['Content-type'] = 'application/json'
             input = json.dumps(input, cls=APIEncoder)
         u = urlparse.urlparse(url + path)
-        self.c = httplib.HTTPConnection(u.hostname, u.port)
+        self.pool = pool
+        self.r = None
+        self.host = u.hostname
+        self.port = u.port
         url = u.path
         if kwargs:
             url += "?" + urllib.urlencode(kwargs)
-        self.c.request(method, url, input, headers)
-        self.r = self.c.getresponse()
+        input_pos = input.tell() if hasattr(input, 'seek') else None
+        self.c, reused = pool.get(self.host, self.port)
+        try:
+            self.c.request(method, url, input, headers)
+            self.r = self.c.getresponse()
+        except (httplib.HTTPException, socket.error):
+            self.c.close()
+            if not reused:
+                raise
+            # The server closed the kept-alive connection while it was
+            # idle. Rewind the body and try once with a fresh one.
+            if input_pos is not None:
+                input.seek(input_pos)
+            self.c = Connection(self.host, self.port)
+            self.c.request(method, url, input, headers)
+            self.r = self.c.getresponse()
         if self.r.status < 200 or self.r.status > 299:
-            raise HttpError(self.r.status)
+            status = self.r.status
+            self.r.read()
+            self.__exit__()
+            raise HttpError(status)
+
+    def getheader(self, name, default = None):
+        return self.r.getheader(name, default)
 
     def read(self, n = None):
         if n is None:
@@ -64,4 +166,11 @@ class HttpRequest(object):
         return self
 
     def __exit__(self, *args):
-        self.c.close()
+        # Only a fully consumed response leaves the connection in a
+        # state where it can be reused for the next request.
+        if self.r is not None and self.r.isclosed() and \
+                not self.r.will_close:
+            self.pool.put(self.host, self.port, self.c)
+        else:
+            self.c.close()
+        self.r = None
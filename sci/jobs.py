@@ -0,0 +1,81 @@
+"""
+    sci.jobs
+    ~~~~~~~~
+
+    Job Bookkeeping
+
+    What sci.slave and sci.agent both do around a job's process: set
+    up its session, record how it exited, find the URL of its log for
+    the final check-in and pick up the slog items that were left
+    behind.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, time
+from .session import Session
+from .slog import find_spools
+from .metrics import JOBS, JOB_CRASHES, JOB_STARTUP, JOB_DURATION
+
+
+def create_session(reaper, session_id, info):
+    """Makes room for, and creates, the session of a job that is about
+       to be spawned. This may take a while - reclaiming space walks
+       and removes old sessions."""
+    reaper.make_room()
+    session = Session.create(session_id)
+    session.state = "running"
+    session.save()
+    info['spawn_time'] = time.time()
+    return session
+
+
+def job_exited(session_id, item, info, return_code):
+    """Records that a job's process has exited. The return code is
+       None if it was lost, with the zygote.
+
+       Returns the session, as the job left it, and the result to
+       report ('success' or 'error')."""
+    JOB_DURATION.observe(time.time() - info['spawn_time'])
+    session = Session.load(session_id)
+    if return_code is None:
+        # Go by what the job recorded, if it got that far
+        return_code = session.return_code
+    result = 'success'
+    if return_code != 0:
+        # We never do that. It must have crashed - clear the session
+        print("Job CRASHED")
+        print("Session ID: %s" % session_id)
+        print("Session Path: %s" % session.path)
+        print("Session Logfile: %s" % session.logfile)
+        print("Run-info: %s" % item)
+        session.return_code = return_code
+        session.state = "done"
+        session.save()
+        result = 'error'
+        JOB_CRASHES.inc()
+    else:
+        print("Job terminated (started in %s ms)" %
+              getattr(session, 'startup_time', '?'))
+        if hasattr(session, 'startup_time'):
+            JOB_STARTUP.observe(session.startup_time / 1000.0)
+    JOBS.inc(result = result)
+    return session, result
+
+
+def log_url(ss_res):
+    """Returns the URL to check in for a shipped log, or '' if the
+       storage server didn't get all of it"""
+    if not ss_res or ss_res.get('status') != 'ok':
+        print("FAILED TO SEND LOG FILE")
+        return ''
+    return ss_res.get('url', '')
+
+
+def leftover_spools(root_path, busy):
+    """Returns (session id, spool file) of the spools to send when
+       pinging - those of all sessions but the `busy` ones, which are
+       still running or whose spool is being sent already"""
+    return [(session_id, filename) for session_id, filename in
+            find_spools(os.path.join(root_path, "sessions"))
+            if session_id not in busy]
@@ -0,0 +1,100 @@
+"""
+    sci.log_shipper
+    ~~~~~~~~~~~~~~~
+
+    Live Log Shipping
+
+    Tails a session's log file while the job is running and appends
+    the new output to the storage server, so that the log can be
+    followed during the build and only the tail is left to send when
+    the job finishes.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, threading, time
+from .http_client import HttpError
+from .upload import file_body
+
+SHIP_INTERVAL = 5
+MAX_CHUNK = 4 * 1024 * 1024
+
+
+def appended(result, size):
+    """Whether the reply to an append says that the file now has
+       `size` bytes. Servers that ignore the offset don't say."""
+    return isinstance(result, dict) and result.get('size') == size
+
+
+class LogShipper(threading.Thread):
+    """Appends a growing file to the storage server
+
+       Each chunk is sent as PUT <path>?offset=N, and the storage
+       server replies with the file's new size. A storage server
+       that doesn't support appending - that doesn't reply with the
+       size - gets the complete file in one PUT at the end instead."""
+    def __init__(self, client, path, filename, interval = SHIP_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.path = path
+        self.filename = filename
+        self.interval = interval
+        self.offset = 0
+        self.appending = True
+        self.result = None
+        self.stopped = threading.Event()
+        # What has been sent, and how long it took
+        self.bytes_sent = 0
+        self.upload_time = 0.0
+
+    def _put(self, body, size, **kwargs):
+        start = time.time()
+        try:
+            self.result = self.client.call(self.path, method = "PUT",
+                                           input = body, **kwargs)
+        finally:
+            self.upload_time += time.time() - start
+        self.bytes_sent += size
+
+    def ship(self):
+        """Sends everything that has been written since last time"""
+        size = os.path.getsize(self.filename)
+        while self.appending and self.offset < size:
+            n = min(size - self.offset, MAX_CHUNK)
+            try:
+                self._put(file_body(self.filename, self.offset, n), n,
+                          offset = self.offset)
+            except HttpError, e:
+                if e.code not in (400, 404, 405):
+                    raise
+                self.appending = False
+                return
+            if not appended(self.result, self.offset + n):
+                print("The storage server can't append to %s - sending "
+                      "all of it at the end" % self.path)
+                self.appending = False
+                return
+            self.offset += n
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.ship()
+            except Exception, e:
+                # We'll try again later, or at the end.
+                print("Failed to ship log %s: %s" % (self.filename, e))
+
+    def finish(self):
+        """Stops tailing, sends the rest and returns the server's reply"""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.ship()
+        if not self.appending:
+            self._put(file_body(self.filename),
+                      os.path.getsize(self.filename))
+        elif self.result is None:
+            # Nothing was ever written
+            self._put("", 0)
+        return self.result
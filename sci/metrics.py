@@ -0,0 +1,178 @@
+"""
+    sci.metrics
+    ~~~~~~~~~~~
+
+    In-process Metrics
+
+    Counters, gauges and histograms that are rendered in the
+    Prometheus text exposition format.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                                    .replace('"', '\\"')
+                                                    .replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """A metric with one value per set of labels
+
+       With `fn`, the value is instead taken from fn() each time the
+       metric is collected."""
+    def __init__(self, name, help, fn = None, registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.register(self)
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def _add(self, amount, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        if self.fn:
+            return self.fn()
+        with self.lock:
+            return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        if self.fn:
+            return [(self.name, (), self.fn())]
+        with self.lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self.values.items())]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        self._add(amount, labels)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount = 1, **labels):
+        self._add(amount, labels)
+
+    def dec(self, amount = 1, **labels):
+        self._add(-amount, labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS,
+                 registry = REGISTRY):
+        Metric.__init__(self, name, help, registry = registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key,
+                                            ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket',
+                                    key + (('le', _format_value(bound)),),
+                                    cumulative))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+# What the slave reports
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200,
+               14400)
+JOBS = Counter('sci_jobs_total', 'Jobs run, by result')
+JOB_CRASHES = Counter('sci_job_crashes_total',
+                      'Jobs whose process exited with an error')
+JOB_START = Histogram('sci_job_start_seconds',
+                      'Time from dispatch until the job process is started')
+JOB_STARTUP = Histogram('sci_job_startup_seconds',
+                        'Time from process start until the job runs')
+JOB_DURATION = Histogram('sci_job_duration_seconds',
+                         'Time the job process ran', JOB_BUCKETS)
+LOG_UPLOAD_BYTES = Counter('sci_log_upload_bytes_total',
+                           'Bytes of job logs sent to the storage server')
+LOG_UPLOAD_SECONDS = Counter('sci_log_upload_seconds_total',
+                             'Time spent sending job logs')
+LOG_UPLOAD_TAIL = Histogram('sci_log_upload_tail_seconds',
+                            'Time spent sending the log after a job ended')
+REGISTRATIONS = Counter('sci_registrations_total',
+                        'Registrations with the job server')
+PING_FAILURES = Counter('sci_ping_failures_total',
+                        'Pings to the job server that failed')
+SLOTS = Gauge('sci_slots', 'Execution slots')
+SLOTS_FREE = Gauge('sci_slots_free', 'Execution slots that can take a job')
+DISK_USED = Gauge('sci_disk_used_ratio',
+                  'Fraction of the disk with the sessions in use')
+RECLAIMED = Counter('sci_reclaimed_bytes_total',
+                    'Bytes of old session data removed')
@@ -0,0 +1,140 @@
+"""
+    sci.parallel_zip
+    ~~~~~~~~~~~~~~~~
+
+    Multi-core ZIP Creation
+
+    Each file is split into blocks that are deflated in parallel and
+    then joined into one deflate stream, the same way pigz does it.
+    Files that are already compressed are stored as they are.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, stat, time, zlib, zipfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_LEVEL = 6
+# Files that are not worth compressing again
+STORED_EXTENSIONS = set(['.zip', '.gz', '.tgz', '.bz2', '.xz', '.lz4',
+                         '.zst', '.7z', '.jar', '.apk', '.png', '.jpg',
+                         '.jpeg', '.gif', '.mp3', '.mp4'])
+SAMPLE_SIZE = 64 * 1024
+# A sample that can't be deflated below this ratio is stored
+MIN_RATIO = 0.9
+
+
+def _deflate_block(data, level, last):
+    # Every block gets its own compressor, and all but the last end
+    # with a sync flush, so the outputs can simply be concatenated.
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last
+                                      else zlib.Z_SYNC_FLUSH)
+
+
+def is_compressible(filename, size):
+    """Guesses whether deflating a file is worth it"""
+    if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS:
+        return False
+    if size < SAMPLE_SIZE:
+        return True
+    with open(filename, "rb") as f:
+        f.seek((size - SAMPLE_SIZE) / 2)
+        sample = f.read(SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO
+
+
+class ParallelZipFile(zipfile.ZipFile):
+    """A ZipFile whose write() deflates on all cores
+
+       `level` is the deflate level 0-9, where 0 stores all files
+       uncompressed."""
+    def __init__(self, filename, mode = "w", level = DEFAULT_LEVEL,
+                 workers = None):
+        zipfile.ZipFile.__init__(self, filename, mode, zipfile.ZIP_DEFLATED,
+                                 allowZip64 = True)
+        self.level = level
+        self.workers = workers or cpu_count()
+        self.pool = ThreadPool(self.workers)
+
+    def close(self):
+        zipfile.ZipFile.close(self)
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _blocks(self, fp):
+        """Yields (data, is_last)"""
+        data = fp.read(BLOCK_SIZE)
+        while True:
+            next_data = fp.read(BLOCK_SIZE)
+            yield data, not next_data
+            if not next_data:
+                return
+            data = next_data
+
+    def write(self, filename, arcname = None, compress_type = None):
+        st = os.stat(filename)
+        if stat.S_ISDIR(st.st_mode):
+            return zipfile.ZipFile.write(self, filename, arcname,
+                                         zipfile.ZIP_STORED)
+        if compress_type is None:
+            if self.level > 0 and is_compressible(filename, st.st_size):
+                compress_type = zipfile.ZIP_DEFLATED
+            else:
+                compress_type = zipfile.ZIP_STORED
+        if compress_type == zipfile.ZIP_STORED:
+            return zipfile.ZipFile.write(self, filename, arcname,
+                                         compress_type)
+
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st[0] & 0xFFFF) << 16L
+        zinfo.compress_type = compress_type
+        zinfo.file_size = st.st_size
+        zinfo.flag_bits = 0x00
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+
+        # Compressed size can be larger than uncompressed size
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        self.fp.write(zinfo.FileHeader(zip64))
+        crc = file_size = compress_size = 0
+        pending = []
+        with open(filename, "rb") as fp:
+            for data, last in self._blocks(fp):
+                file_size += len(data)
+                crc = zlib.crc32(data, crc) & 0xffffffff
+                pending.append(self.pool.apply_async(_deflate_block,
+                                                     (data, self.level,
+                                                      last)))
+                # Bound the memory used by blocks waiting to be written
+                while len(pending) > 2 * self.workers or \
+                        (last and pending):
+                    buf = pending.pop(0).get()
+                    compress_size += len(buf)
+                    self.fp.write(buf)
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        if not zip64 and (file_size > zipfile.ZIP64_LIMIT or
+                          compress_size > zipfile.ZIP64_LIMIT):
+            raise RuntimeError('File size has increased during compressing')
+
+        # Rewrite the header, now with the correct CRC and sizes
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset, 0)
+        self.fp.write(zinfo.FileHeader(zip64))
+        self.fp.seek(position, 0)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
@@ -0,0 +1,199 @@
+"""
+    sci.reaper
+    ~~~~~~~~~~
+
+    Session Garbage Collection
+
+    Removes the workspaces of finished sessions after a while, and
+    whole sessions after a longer while. When the disk fills up, the
+    oldest sessions are reclaimed until usage is back below the low
+    watermark.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, threading, time, shutil
+from .session_store import SessionStore
+from .resources import MIN_FREE_DISK
+from .utils import prune_sha1_cache
+
+# Workspaces are removed this long after the session ended, but the
+# log and config are kept.
+KEEP_WORKSPACE = 24 * 3600
+# After this long, the whole session directory is removed.
+KEEP_SESSION = 30 * 24 * 3600
+# Fractions of the disk in use
+HIGH_WATERMARK = 0.90
+LOW_WATERMARK = 0.80
+REAP_INTERVAL = 600
+
+
+def disk_usage(path):
+    """Returns the number of bytes allocated below `path`"""
+    if os.path.islink(path):
+        return 0
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def disk_used_fraction(path):
+    st = os.statvfs(path)
+    if not st.f_blocks:
+        return 0.0
+    return 1.0 - float(st.f_bavail) / st.f_blocks
+
+
+class SessionReaper(threading.Thread):
+    def __init__(self, root_path, keep_workspace = KEEP_WORKSPACE,
+                 keep_session = KEEP_SESSION, high = HIGH_WATERMARK,
+                 low = LOW_WATERMARK, min_free = MIN_FREE_DISK):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = os.path.join(root_path, "sessions")
+        self.sha1_cache = os.path.join(root_path, "cache", "sha1")
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.keep_workspace = keep_workspace
+        self.keep_session = keep_session
+        self.high = high
+        self.low = low
+        # The slave doesn't take jobs with less than this free, so
+        # that counts as being above the high watermark too
+        self.min_free = min_free
+        # Keeps when sessions ended, and their sizes once measured, so
+        # that finding out how much can be reclaimed doesn't require
+        # walking the file system
+        self.index = SessionStore.open(root_path)
+        self.reap_lock = threading.Lock()
+        self.measure_cv = threading.Condition()
+        self.to_measure = []
+        self.room_wanted = False
+        self.reclaimed = 0
+
+    def finished(self, session):
+        """Registers a session that has ended. Its size is measured in
+           the background."""
+        self.index.update(session.id, ended = time.time(), size = None,
+                          workspace = True)
+        with self.measure_cv:
+            self.to_measure.append(session.id)
+            self.measure_cv.notify()
+
+    def request_room(self):
+        """Has make_room() run on the reaper thread, without waiting for
+           it"""
+        with self.measure_cv:
+            self.room_wanted = True
+            self.measure_cv.notify()
+
+    def _remove_workspace(self, session_id, entry):
+        workspace = os.path.join(self.path, session_id, "workspace")
+        before = entry.get("size")
+        if before is None:
+            before = disk_usage(os.path.join(self.path, session_id))
+        if os.path.islink(workspace):
+            os.remove(workspace)
+        elif os.path.exists(workspace):
+            shutil.rmtree(workspace, ignore_errors = True)
+        # Only the log and config are left, so this is quick
+        after = disk_usage(os.path.join(self.path, session_id))
+        self.index.update(session_id, workspace = False, size = after)
+        return max(before - after, 0)
+
+    def _remove_session(self, session_id, entry):
+        path = os.path.join(self.path, session_id)
+        size = entry.get("size")
+        if size is None:
+            size = disk_usage(path)
+        shutil.rmtree(path, ignore_errors = True)
+        self.index.remove(session_id)
+        return size
+
+    def reap(self):
+        """Applies the retention policy. Returns the reclaimed bytes."""
+        reclaimed = 0
+        now = time.time()
+        with self.reap_lock:
+            for session_id, entry in self.index.oldest_first():
+                age = now - entry.get("ended", now)
+                if age > self.keep_session:
+                    reclaimed += self._remove_session(session_id, entry)
+                elif age > self.keep_workspace and entry.get("workspace"):
+                    reclaimed += self._remove_workspace(session_id, entry)
+            # The files they were computed for are gone by now
+            prune_sha1_cache(self.sha1_cache, self.keep_session)
+        return self._reclaimed(reclaimed)
+
+    def make_room(self):
+        """Cheap enough to call before every job: if the disk is above
+           the high watermark, or has less than `min_free` bytes free,
+           removes the oldest workspaces (and then the oldest sessions)
+           until it is below the low watermark, and has the space
+           between the watermarks free on top of `min_free`. Returns
+           the reclaimed bytes.
+
+           Sessions that haven't been measured yet are left for later,
+           rather than walked here."""
+        st = os.statvfs(self.path)
+        total = st.f_blocks * st.f_frsize
+        free = st.f_bavail * st.f_frsize
+        if free >= (1 - self.high) * total and free >= self.min_free:
+            return 0
+        needed = max((1 - self.low) * total,
+                     self.min_free + (self.high - self.low) * total) - free
+        reclaimed = 0
+        unmeasured = set()
+        with self.reap_lock:
+            for session_id, entry in self.index.oldest_first():
+                if reclaimed >= needed:
+                    break
+                if entry.get("size") is None:
+                    unmeasured.add(session_id)
+                elif entry.get("workspace"):
+                    reclaimed += self._remove_workspace(session_id, entry)
+            # With the sizes left after removing the workspaces
+            for session_id, entry in self.index.oldest_first():
+                if reclaimed >= needed:
+                    break
+                if entry.get("size") is None:
+                    unmeasured.add(session_id)
+                else:
+                    reclaimed += self._remove_session(session_id, entry)
+        if unmeasured:
+            with self.measure_cv:
+                self.to_measure.extend(unmeasured - set(self.to_measure))
+                self.measure_cv.notify()
+        return self._reclaimed(reclaimed)
+
+    def _reclaimed(self, nbytes):
+        if nbytes:
+            self.reclaimed += nbytes
+            print("Reclaimed %d kB of session data" % (nbytes / 1024))
+        return nbytes
+
+    def _measure(self):
+        with self.measure_cv:
+            if not self.to_measure and not self.room_wanted:
+                self.measure_cv.wait(REAP_INTERVAL)
+            to_measure = self.to_measure
+            self.to_measure = []
+        for session_id in to_measure:
+            size = disk_usage(os.path.join(self.path, session_id))
+            self.index.update(session_id, size = size)
+
+    def run(self):
+        last_reap = 0
+        while True:
+            self._measure()
+            if self.room_wanted:
+                self.room_wanted = False
+                self.make_room()
+            if last_reap + REAP_INTERVAL < time.time():
+                last_reap = time.time()
+                self.reap()
@@ -0,0 +1,67 @@
+"""
+    sci.recipe_cache
+    ~~~~~~~~~~~~~~~~
+
+    Recipe Cache
+
+    Recipes are identified by the SHA-1 of their source. The slave
+    keeps the sources, and their compiled code, so that a recipe only
+    has to be transferred and compiled once per node no matter how
+    many sessions run it.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, imp, marshal, hashlib
+
+
+class RecipeCache(object):
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+    @classmethod
+    def ref(cls, source):
+        return hashlib.sha1(source).hexdigest()
+
+    def source_file(self, ref):
+        return os.path.join(self.path, "%s.py" % ref)
+
+    def _write(self, fname, data):
+        tmp_fname = "%s.tmp.%d" % (fname, os.getpid())
+        with open(tmp_fname, "wb") as f:
+            f.write(data)
+        os.rename(tmp_fname, fname)
+
+    def has(self, ref):
+        return os.path.exists(self.source_file(ref))
+
+    def put(self, source):
+        """Stores a recipe and returns its ref"""
+        if isinstance(source, unicode):
+            source = source.encode("utf-8")
+        ref = self.ref(source)
+        if not self.has(ref):
+            self._write(self.source_file(ref), source)
+        return ref
+
+    def load(self, ref):
+        """Returns the compiled code of a recipe"""
+        fname = self.source_file(ref)
+        compiled = fname + "c"
+        magic = imp.get_magic()
+        code = None
+        try:
+            with open(compiled, "rb") as f:
+                if f.read(len(magic)) == magic:
+                    code = marshal.loads(f.read())
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        if not code:
+            with open(fname, "rb") as f:
+                code = compile(f.read(), fname, "exec")
+            self._write(compiled, magic + marshal.dumps(code))
+        return code
@@ -0,0 +1,124 @@
+"""
+    sci.resources
+    ~~~~~~~~~~~~~
+
+    Node Resources
+
+    A compact snapshot of the node's cores, load, memory and disk,
+    read from /proc and statvfs, which the slave sends to the job
+    server when it registers and pings. It is cheap enough to take
+    every second, so the slave can ping early when the picture
+    changes, and stop taking jobs while memory or disk is short.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, time
+from multiprocessing import cpu_count
+
+MB = 1024 * 1024
+# Below these, the slave doesn't take any jobs
+MIN_FREE_MEMORY = 512 * MB
+MIN_FREE_DISK = 5 * 1024 * MB
+# Changes that are reported before the next regular ping
+LOAD_CHANGE = 0.25       # of the number of cores
+MEMORY_CHANGE = 0.10     # of the total memory
+DISK_CHANGE = 0.05       # of the disk size
+# Don't ping more often than this, however much things change
+MIN_REPORT_INTERVAL = 5
+
+
+def _meminfo():
+    info = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                info[name] = int(value.split()[0]) * 1024
+    except (IOError, ValueError):
+        pass
+    return info
+
+
+def snapshot(path):
+    """Returns the node's resources, with sizes in MB"""
+    mem = _meminfo()
+    mem_total = mem.get("MemTotal", 0)
+    mem_free = mem.get("MemAvailable")
+    if mem_free is None:
+        mem_free = (mem.get("MemFree", 0) + mem.get("Buffers", 0) +
+                    mem.get("Cached", 0))
+    st = os.statvfs(path)
+    return {"cores": cpu_count(),
+            "load": [round(l, 2) for l in os.getloadavg()],
+            "mem_total": mem_total / MB,
+            "mem_free": mem_free / MB,
+            "disk_total": st.f_blocks * st.f_frsize / MB,
+            "disk_free": st.f_bavail * st.f_frsize / MB}
+
+
+def pressure(snap):
+    """Returns what the node is short of, if anything"""
+    short = []
+    if snap["mem_total"] and snap["mem_free"] * MB < MIN_FREE_MEMORY:
+        short.append("memory")
+    if snap["disk_free"] * MB < MIN_FREE_DISK:
+        short.append("disk")
+    return short
+
+
+def changed(old, new):
+    """Whether the resources have changed enough to tell the job server"""
+    if pressure(old) != pressure(new):
+        return True
+    if abs(new["load"][0] - old["load"][0]) > LOAD_CHANGE * new["cores"]:
+        return True
+    if abs(new["mem_free"] - old["mem_free"]) > \
+            MEMORY_CHANGE * new["mem_total"]:
+        return True
+    return abs(new["disk_free"] - old["disk_free"]) > \
+        DISK_CHANGE * new["disk_total"]
+
+
+class ResourceMonitor(object):
+    """Keeps the latest snapshot, and what was last reported
+
+       When the disk runs short, make_room() is called to free some
+       of it, at most every MIN_REPORT_INTERVAL. It shouldn't block -
+       what it frees shows in the samples after it is done."""
+    def __init__(self, path, make_room = None):
+        self.path = path
+        self.make_room = make_room
+        self.current = snapshot(path)
+        self.reported = None
+        self.reported_time = 0
+        self.room_time = 0
+
+    def sample(self):
+        self.current = snapshot(self.path)
+        if self.make_room and "disk" in pressure(self.current) and \
+                time.time() - self.room_time >= MIN_REPORT_INTERVAL:
+            self.room_time = time.time()
+            self.make_room()
+        return self.current
+
+    @property
+    def accepting(self):
+        """False when the node is too short of memory or disk for a job"""
+        return not pressure(self.current)
+
+    def should_report(self):
+        """Whether to ping before the regular interval is up"""
+        if self.reported is None:
+            return False
+        if time.time() - self.reported_time < MIN_REPORT_INTERVAL:
+            return False
+        return changed(self.reported, self.current)
+
+    def report(self):
+        """Returns the payload for a register or ping"""
+        self.reported = self.current
+        self.reported_time = time.time()
+        return {"resources": self.current,
+                "accepting": self.accepting,
+                "pressure": pressure(self.current)}
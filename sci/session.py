@@ -6,12 +6,14 @@
 
     Every job (and sub-job) is running in a session, which
     provides the directory structure needed for gathering
-    log files and more.
+    log files and more. The sessions' state is kept in the
+    slave's session store.
 
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
 import time, os, json
+from .session_store import SessionStore
 
 
 class Session(object):
@@ -29,9 +31,7 @@ class Session(object):
         self.return_value = None
 
     def save(self):
-        with open(os.path.join(self.__path(self.id), "config.json"), "w") as f:
-            d = self.__dict__
-            f.write(json.dumps(d))
+        Session.store().save(self.id, self.__dict__)
 
     @classmethod
     def create(cls, id):
@@ -42,12 +42,19 @@ class Session(object):
 
     @classmethod
     def load(cls, id):
-        with open(os.path.join(cls.__path(id), "config.json"), "r") as f:
-            d = json.loads(f.read())
-            s = Session(d['id'])
-            for key in d:
-                setattr(s, key, d[key])
-            return s
+        d = cls.store().load(id)
+        if d is None:
+            # Saved before there was a session store
+            with open(os.path.join(cls.__path(id), "config.json"), "r") as f:
+                d = json.loads(f.read())
+        s = Session(d['id'])
+        for key in d:
+            setattr(s, key, d[key])
+        return s
+
+    @classmethod
+    def store(cls):
+        return SessionStore.open(cls.root_path)
 
     @classmethod
     def __path(cls, sid):
@@ -0,0 +1,221 @@
+"""
+    sci.session_store
+    ~~~~~~~~~~~~~~~~~
+
+    Session Catalog
+
+    All sessions on the slave, with their state, timings, return
+    code and disk usage, in an SQLite database (in WAL mode, so that
+    the slave and the jobs can use it at the same time). Every state
+    change is recorded, and each save is a single transaction, so a
+    session is never seen half-written.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, json, sqlite3, threading, time
+from contextlib import contextmanager
+
+BUSY_TIMEOUT = 30
+# A session in one of these states has ended. Others end when the
+# slave is done with them - has shipped the log and checked in - and
+# tells the reaper, which sets the end time. Until then, the reaper
+# leaves them alone.
+FINAL_STATES = ("abandoned",)
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE sessions (
+    id TEXT PRIMARY KEY,
+    state TEXT,
+    created REAL,
+    ended REAL,
+    return_code INTEGER,
+    size INTEGER,
+    workspace INTEGER NOT NULL DEFAULT 1,
+    data TEXT NOT NULL
+);
+CREATE INDEX sessions_state ON sessions (state);
+CREATE INDEX sessions_ended ON sessions (ended);
+CREATE TABLE transitions (
+    session_id TEXT NOT NULL,
+    state TEXT,
+    time REAL NOT NULL
+);
+CREATE INDEX transitions_session ON transitions (session_id);
+"""
+COLUMNS = "id, state, created, ended, return_code, size, workspace"
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class SessionStore(object):
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.filename = os.path.join(root_path, "sessions.db")
+        self.local = threading.local()
+        with self.transaction() as db:
+            if db.execute("PRAGMA user_version").fetchone()[0] == 0:
+                for statement in SCHEMA.split(";"):
+                    db.execute(statement)
+                self._import_legacy(db)
+                db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    @classmethod
+    def open(cls, root_path):
+        """Returns the store of the sessions below `root_path`"""
+        root_path = os.path.realpath(root_path)
+        with _stores_lock:
+            store = _stores.get(root_path)
+            if not store:
+                store = _stores[root_path] = cls(root_path)
+            return store
+
+    def _db(self):
+        # A connection per thread, and a new one after a fork
+        if getattr(self.local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.filename, timeout = BUSY_TIMEOUT,
+                                 isolation_level = None)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return self.local.db
+
+    @contextmanager
+    def transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _import_legacy(self, db):
+        """Imports the sessions saved as config.json files, and what the
+           reaper kept in index.json, by earlier versions"""
+        path = os.path.join(self.root_path, "sessions")
+        if not os.path.isdir(path):
+            return
+        for session_id in os.listdir(path):
+            try:
+                with open(os.path.join(path, session_id, "config.json")) as f:
+                    self._save(db, session_id, json.loads(f.read()))
+            except (IOError, ValueError):
+                pass
+        try:
+            with open(os.path.join(path, "index.json")) as f:
+                entries = json.loads(f.read())
+        except (IOError, ValueError):
+            return
+        for session_id, entry in entries.items():
+            self._update(db, session_id, **entry)
+
+    def _save(self, db, session_id, data, now = None):
+        now = now or time.time()
+        state = data.get("state")
+        row = db.execute("SELECT state, ended FROM sessions WHERE id = ?",
+                         (session_id,)).fetchone()
+        ended = row[1] if row else None
+        if ended is None:
+            ended = data.get("ended") or None
+        if ended is None and state in FINAL_STATES:
+            ended = now
+        values = (state, data.get("created"), ended, data.get("return_code"),
+                  json.dumps(data), session_id)
+        if row:
+            db.execute("UPDATE sessions SET state = ?, created = ?, "
+                       "ended = ?, return_code = ?, data = ? WHERE id = ?",
+                       values)
+        else:
+            db.execute("INSERT INTO sessions (state, created, ended, "
+                       "return_code, data, id) VALUES (?, ?, ?, ?, ?, ?)",
+                       values)
+        if not row or row[0] != state:
+            db.execute("INSERT INTO transitions VALUES (?, ?, ?)",
+                       (session_id, state, now))
+
+    def save(self, session_id, data):
+        with self.transaction() as db:
+            self._save(db, session_id, data)
+
+    def load(self, session_id):
+        """Returns what was saved for the session, or None"""
+        row = self._db().execute("SELECT data FROM sessions WHERE id = ?",
+                                 (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _update(self, db, session_id, **kwargs):
+        names = [k for k in ("ended", "size", "workspace") if k in kwargs]
+        if names:
+            db.execute("UPDATE sessions SET %s WHERE id = ?" %
+                       ", ".join("%s = ?" % k for k in names),
+                       [kwargs[k] for k in names] + [session_id])
+
+    def update(self, session_id, **kwargs):
+        """Sets when the session ended, its size and whether its
+           workspace is still there"""
+        with self.transaction() as db:
+            self._update(db, session_id, **kwargs)
+
+    def remove(self, session_id):
+        """Records that the session has been removed from disk"""
+        with self.transaction() as db:
+            db.execute("UPDATE sessions SET state = 'removed', size = 0, "
+                       "workspace = 0 WHERE id = ?", (session_id,))
+            db.execute("INSERT INTO transitions VALUES (?, ?, ?)",
+                       (session_id, "removed", time.time()))
+
+    def abandon_running(self):
+        """Marks the sessions that were running when the slave stopped
+           as abandoned, and returns their ids"""
+        with self.transaction() as db:
+            ids = [row[0] for row in db.execute(
+                "SELECT id FROM sessions WHERE state IN "
+                "('created', 'running')")]
+            for session_id in ids:
+                data = json.loads(db.execute(
+                    "SELECT data FROM sessions WHERE id = ?",
+                    (session_id,)).fetchone()[0])
+                data["state"] = "abandoned"
+                self._save(db, session_id, data)
+        return ids
+
+    def _query(self, where = "", args = (), order = "created", limit = None):
+        sql = "SELECT %s FROM sessions" % COLUMNS
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY " + order
+        if limit:
+            sql += " LIMIT %d" % limit
+        names = [c.strip() for c in COLUMNS.split(",")]
+        return [dict(zip(names, row))
+                for row in self._db().execute(sql, args)]
+
+    def oldest_first(self):
+        """Returns (session id, entry) of the ended sessions that are
+           still on disk, the ones that ended first first"""
+        return [(entry.pop("id"), entry) for entry in
+                self._query("ended IS NOT NULL AND state != 'removed'",
+                            order = "ended")]
+
+    def sessions(self, state = None, limit = None):
+        if state is None:
+            return self._query(limit = limit)
+        return self._query("state = ?", (state,), limit = limit)
+
+    def crashed(self, limit = None):
+        return self._query("return_code != 0", order = "ended DESC",
+                           limit = limit)
+
+    def largest(self, limit = 10):
+        return self._query("size IS NOT NULL AND state != 'removed'",
+                           order = "size DESC", limit = limit)
+
+    def transitions(self, session_id):
+        """Returns (state, time) of the session's state changes"""
+        return self._db().execute("SELECT state, time FROM transitions "
+                                  "WHERE session_id = ? ORDER BY rowid",
+                                  (session_id,)).fetchall()
@@ -8,26 +8,34 @@
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
-import web, json, os, threading, subprocess
+import web, json, os, threading, subprocess, traceback
 from sci.daemon import Daemon
 from sci.session import Session, time
-from sci.http_client import HttpClient
-from sci.utils import random_sha1
-import ConfigParser
-from Queue import Queue, Full, Empty
+from sci.http_client import HttpClient, pool
+from sci.log_shipper import LogShipper
+from sci.slog import SPOOL_NAME, send_spool
+from sci.reaper import SessionReaper, disk_used_fraction
+from sci.zygote import Zygote
+from sci.jobs import create_session, job_exited, log_url, leftover_spools
+from sci.metrics import (REGISTRY, JOB_START, LOG_UPLOAD_BYTES,
+                         LOG_UPLOAD_SECONDS, LOG_UPLOAD_TAIL, REGISTRATIONS,
+                         PING_FAILURES, SLOTS, SLOTS_FREE, DISK_USED,
+                         RECLAIMED)
+from sci.resources import ResourceMonitor, pressure
+from sci.utils import load_node_id
 
 urls = (
     '/dispatch', 'StartJob',
+    '/metrics', 'Metrics',
 )
 
 EXPIRY_TTL = 60
+RUN_JOB = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..',
+                       "run_job.py")
 DEFAULT_PORT = 6700
 
 app = web.application(urls, globals())
 
-requestq = Queue()
-cv = threading.Condition()
-
 
 def jsonify(**kwargs):
     web.header('Content-Type', 'application/json')
@@ -41,20 +49,37 @@ def abort(status, data):
 
 class StartJob:
     def POST(self):
-        if not put_item(web.data()):
+        if not web.config.resources.accepting:
+            # It may have been cleaned up since
+            web.config.resources.sample()
+        if not web.config.resources.accepting:
+            abort(412, "Low on %s" %
+                  " and ".join(pressure(web.config.resources.current)))
+        if not web.config.slots.put(web.data()):
             abort(412, "Busy")
         return jsonify(status = "started")
 
 
+class Metrics:
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return REGISTRY.render()
+
+
 class StatusThread(threading.Thread):
-    def __init__(self, js_url, node_id, nick, port):
+    def __init__(self, js_url, node_id, nick, port, slots = 1,
+                 resources = None, execthreads = ()):
         threading.Thread.__init__(self)
         self.kill_received = False
         self.registered = False
+        self.registrations = 0
         self.js = HttpClient(js_url)
         self.node_id = node_id
         self.nick = nick
         self.port = port
+        self.slots = slots
+        self.resources = resources
+        self.execthreads = execthreads
 
     def ttl_expired(self):
         if web.config.last_status + EXPIRY_TTL < int(time.time()):
@@ -63,27 +88,49 @@ class StatusThread(threading.Thread):
     def send_ping(self):
         web.config.last_status = int(time.time())
         print("%s pinging" % self.node_id)
+        pool.evict_idle()
 
         try:
             self.js.call("/agent/ping/%s" % self.node_id,
-                         method = "POST")
+                         input = self.resources.report())
         except:
             # Any exceptions while we ping indicate that the jobserver
             # is down/unavailable - so re-register and hope it works better.
             print("Exception while pinging - re-registering")
+            PING_FAILURES.inc()
             self.registered = False
+            return
+        self.send_spools()
+
+    def send_spools(self):
+        """Sends what jobs have left in their slog spools, because the
+           job server couldn't be reached when they ended"""
+        # The execution threads send the spools of their own jobs
+        busy = set(t.session_id for t in self.execthreads)
+        for session_id, filename in leftover_spools(Session.root_path, busy):
+            try:
+                if not send_spool(self.js, session_id, filename):
+                    return
+            except (IOError, OSError):
+                # The session has been removed
+                pass
 
     def send_register(self):
         print("Registering")
         web.config.last_status = int(time.time())
+        info = {"id": self.node_id,
+                'nick': self.nick,
+                "port": self.port,
+                "slots": self.slots,
+                "labels": [os.uname()[0], os.uname()[4]]}
+        info.update(self.resources.report())
         try:
-            self.js.call("/agent/register",
-                         input = {"id": self.node_id,
-                                  'nick': self.nick,
-                                  "port": self.port,
-                                  "labels": [os.uname()[0], os.uname()[4]]})
+            self.js.call("/agent/register", input = info)
             print("%s registered - listening to %d" % (self.node_id, self.port))
             self.registered = True
+            self.registrations += 1
+            REGISTRATIONS.inc(kind = "initial" if self.registrations == 1
+                              else "re-registration")
         except:
             print("Failed to register. Will try again")
             self.registered = False
@@ -93,152 +140,189 @@ class StatusThread(threading.Thread):
             self.send_register()
             time.sleep(5)
             while not self.kill_received and self.registered:
-                if self.ttl_expired():
+                # Sharp changes in the resources are reported early
+                self.resources.sample()
+                if self.ttl_expired() or self.resources.should_report():
                     self.send_ping()
                 time.sleep(1)
 
 
-def get_item():
-    with cv:
-        while True:
-            try:
-                item = requestq.get_nowait()
-                if item == None:
-                    # Our 'busy' marker. Guess we are not as busy as we
-                    # believe right now.
-                    continue
-                # Oh, it succeeded. Let's act 'busy'
-                requestq.put(None)
-                break
-            except Empty:
-                cv.wait()
-    return item
+class SlotPool(object):
+    """Hands out dispatched jobs to a fixed number of execution slots
+
+       A job is only accepted when there is a slot free to run it, so
+       the job server is told that we are busy once all are taken."""
+    def __init__(self, count):
+        self.count = count
+        self.cv = threading.Condition()
+        self.pending = []
+        self.running = 0
+        self.closed = False
+
+    def _free(self):
+        return self.count - self.running - len(self.pending)
+
+    def free(self):
+        with self.cv:
+            return self._free()
+
+    def put(self, item):
+        """Returns False if all slots are working"""
+        with self.cv:
+            if self.closed or self._free() <= 0:
+                return False
+            self.pending.append((time.time(), item))
+            self.cv.notify()
+            return True
 
+    def get(self):
+        """Blocks until there is a job to run, or returns None when closed
 
-def put_item(item):
-    """Returns False if the ExcutionThread is working"""
-    with cv:
-        try:
-            requestq.put_nowait(item)
-            cv.notify()
-            return True
-        except Full:
-            return False
+           The job is returned together with the time it was put."""
+        with self.cv:
+            while not self.pending and not self.closed:
+                self.cv.wait()
+            if self.closed:
+                return None
+            self.running += 1
+            return self.pending.pop(0)
 
+    def done(self):
+        with self.cv:
+            self.running -= 1
 
-def replace_item(item):
-    # Assumes that the queue already has an item in it.
-    with cv:
-        requestq.get()
-        requestq.put(item)
-        cv.notify()
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
 
 
 class ExecutionThread(threading.Thread):
-    def __init__(self):
+    def __init__(self, slots, reaper, zygote = None, slot = 0):
         threading.Thread.__init__(self)
         self.kill_received = False
+        self.slots = slots
+        self.reaper = reaper
+        self.zygote = zygote
+        self.slot = slot
+        self.session_id = None
+        self.js = HttpClient(web.config._job_server)
 
     def send_available(self, session_id, result, output, log_file):
         web.config.last_status = int(time.time())
-        print("%s checking in (available)" % web.config.node_id)
+        print("%s checking in (available, slot %d)" % (web.config.node_id,
+                                                       self.slot))
 
-        client = HttpClient(web.config._job_server)
-        client.call("/agent/available/%s" % web.config.node_id,
-                    input = {'session_id': session_id,
-                             'result': result,
-                             'output': output,
-                             'log_file': log_file})
+        self.js.call("/agent/available/%s" % web.config.node_id,
+                     input = {'session_id': session_id,
+                              'slot': self.slot,
+                              'result': result,
+                              'output': output,
+                              'log_file': log_file})
 
     def send_busy(self, session_id):
         web.config.last_status = int(time.time())
-        print("%s checking in (busy)" % web.config.node_id)
+        print("%s checking in (busy, slot %d)" % (web.config.node_id,
+                                                  self.slot))
 
-        client = HttpClient(web.config._job_server)
-        client.call("/agent/busy/%s" % web.config.node_id,
-                    input = {'session_id': session_id})
+        self.js.call("/agent/busy/%s" % web.config.node_id,
+                     input = {'session_id': session_id,
+                              'slot': self.slot})
 
     def run(self):
         while not self.kill_received:
-            item = get_item()
-
-            session_id = json.loads(item)['session_id']
-
-            # Fetch session information
-            js = HttpClient(web.config._job_server)
-            info = js.call('/agent/session/%s' % session_id)
-
-            session = Session.create(session_id)
-            run_job = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                   '..',
-                                   "run_job.py")
-            args = [run_job, web.config._job_server, session_id]
-            stdout = open(session.logfile, "w")
-            session.state = "running"
+            job = self.slots.get()
+            if job is None:
+                break
+            try:
+                self.run_item(*job)
+            except Exception:
+                # Keep serving the slot
+                traceback.print_exc()
+                print("Failed to run %s" % job[1])
+                self.item_failed()
+            finally:
+                self.session_id = None
+                self.slots.done()
+
+    def item_failed(self):
+        """Ends the session of an item that failed, if it got that far,
+           so that it is reaped like any other"""
+        if self.session_id is None:
+            return
+        try:
+            session = Session.load(self.session_id)
+        except (IOError, ValueError):
+            # It was never created
+            return
+        if session.state == "running":
+            session.state = "done"
             session.save()
+        self.reaper.finished(session)
+
+    def run_item(self, received, item):
+        session_id = json.loads(item)['session_id']
+        self.session_id = session_id
+
+        # Fetch session information
+        # Ask for just the recipe's ref - the job fetches the recipe
+        # itself if it isn't cached on this node.
+        info = self.js.call('/agent/session/%s' % session_id, recipe_ref = 1)
+
+        session = create_session(self.reaper, session_id, info)
+        proc = None
+        if self.zygote:
+            proc = self.zygote.spawn(web.config._job_server, session_id, info,
+                                     session.logfile)
+        if not proc:
+            args = [RUN_JOB, web.config._job_server, session_id]
+            stdout = open(session.logfile, "w")
             proc = subprocess.Popen(args, stdin = subprocess.PIPE,
-                                    stdout = stdout, stderr = subprocess.STDOUT,
+                                    stdout = stdout,
+                                    stderr = subprocess.STDOUT,
                                     cwd = web.config._path)
             proc.stdin.write(json.dumps(info))
             proc.stdin.close()
-            self.send_busy(session_id)
-            return_code = proc.wait()
-            session = Session.load(session.id)
-            result = 'success'
-            if return_code != 0:
-                # We never do that. It must have crashed - clear the session
-                print("Job CRASHED")
-                print("Session ID: %s" % session_id)
-                print("Session Path: %s" % session.path)
-                print("Session Logfile: %s" % session.logfile)
-                print("Run-info: %s" % item)
-                session.return_code = return_code
-                session.state = "done"
-                session.save()
-                result = 'error'
-            else:
-                print("Job terminated")
-
-            url = "/f/%s/%s.log" % (info['build_uuid'], session_id)
-            ss = HttpClient(info['ss_url'])
-            ss_res = ss.call(url, method = 'PUT',
-                             input = open(session.logfile, 'rb'))
-            if ss_res['status'] != 'ok':
-                print("FAILED TO SEND LOG FILE")
-                ss_res['url'] = ''
-
-            output = session.return_value
-            self.send_available(session_id, result, output, ss_res['url'])
+        JOB_START.observe(time.time() - received)
+        url = "/f/%s/%s.log" % (info['build_uuid'], session_id)
+        shipper = LogShipper(HttpClient(info['ss_url']), url, session.logfile)
+        shipper.start()
+        self.send_busy(session_id)
+        session, result = job_exited(session_id, item, info, proc.wait())
+
+        spool = os.path.join(session.path, SPOOL_NAME)
+        if os.path.exists(spool) and \
+                not send_spool(self.js, session_id, spool):
+            print("Slog items are left in %s - will try again when pinging" %
+                  spool)
+
+        tail_start = time.time()
+        try:
+            ss_res = shipper.finish()
+        finally:
+            LOG_UPLOAD_TAIL.observe(time.time() - tail_start)
+            LOG_UPLOAD_BYTES.inc(shipper.bytes_sent)
+            LOG_UPLOAD_SECONDS.inc(shipper.upload_time)
+
+        output = session.return_value
+        self.send_available(session_id, result, output, log_url(ss_res))
+        self.reaper.finished(session)
 
 
 class Slave(Daemon):
-    def __init__(self, nickname, jobserver, port = DEFAULT_PORT, path = '.'):
+    def __init__(self, nickname, jobserver, port = DEFAULT_PORT, path = '.',
+                 slots = 1, zygote = False):
         self.nick = nickname
         self.jobserver = jobserver
         self.port = port
+        self.slots = slots
+        self.zygote = zygote
         self.path = os.path.realpath(path)
         pidfile = '/tmp/scigent_%s' % nickname
         super(Slave, self).__init__(pidfile,
                                     stdout='/dev/stdout',
                                     stderr='/dev/stderr')
 
-    def get_config(self, path):
-        c = ConfigParser.ConfigParser()
-        c.read(os.path.join(path, "config.ini"))
-        try:
-            return {"node_id": c.get("sci", "node_id")}
-        except ConfigParser.NoOptionError:
-            return None
-        except ConfigParser.NoSectionError:
-            return None
-
-    def save_config(self, path, node_id):
-        c = ConfigParser.ConfigParser()
-        c.add_section('sci')
-        c.set("sci", "node_id", node_id)
-        with open(os.path.join(path, "config.ini"), "wb") as configfile:
-            c.write(configfile)
-
     def run(self):
         if not os.path.exists(self.path):
             os.makedirs(self.path)
@@ -247,22 +331,40 @@ class Slave(Daemon):
         web.config._path = self.path
         web.config.port = self.port
         web.config.nick = self.nick
+        web.config.slots = SlotPool(self.slots)
 
         Session.set_root_path(web.config._path)
+        # Whatever was running when the slave stopped won't finish now
+        abandoned = Session.store().abandon_running()
+        if abandoned:
+            print("Abandoned %d sessions" % len(abandoned))
 
-        config = self.get_config(web.config._path)
-        if not config:
-            node_id = 'A' + random_sha1()
-            self.save_config(web.config._path, node_id)
-        else:
-            node_id = config["node_id"]
+        node_id = load_node_id(web.config._path)
         web.config.node_id = node_id
 
-        status = StatusThread(self.jobserver, node_id, self.nick, self.port)
-        execthread = ExecutionThread()
+        reaper = SessionReaper(web.config._path)
+        web.config.resources = ResourceMonitor(self.path,
+                                               reaper.request_room)
+        SLOTS.set(self.slots)
+        SLOTS_FREE.set_function(web.config.slots.free)
+        DISK_USED.set_function(lambda: disk_used_fraction(web.config._path))
+        RECLAIMED.set_function(lambda: reaper.reclaimed)
+        zygote = None
+        if self.zygote:
+            zygote = Zygote(RUN_JOB, web.config._path)
+            zygote.start()
+        execthreads = [ExecutionThread(web.config.slots, reaper, zygote, slot)
+                       for slot in range(self.slots)]
+        status = StatusThread(self.jobserver, node_id, self.nick, self.port,
+                              self.slots, web.config.resources, execthreads)
+        reaper.start()
         status.start()
-        execthread.start()
+        for execthread in execthreads:
+            execthread.start()
         web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", self.port))
         status.kill_received = True
-        execthread.kill_received = True
-        put_item(None)
+        for execthread in execthreads:
+            execthread.kill_received = True
+        web.config.slots.close()
+        if zygote:
+            zygote.stop()
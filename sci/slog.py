@@ -6,18 +6,33 @@
 
     A build will stream structured log data to the job server.
 
+    The items are sent in batches by a background writer, so that
+    the build doesn't have to wait for the job server. Items that
+    can't be delivered are spooled to disk and sent later.
+
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
-import json
+import glob, json, os, threading, time
+
+BATCH_SIZE = 100
+LINGER_TIME = 0.5
+SPOOL_NAME = 'slog.spool'
 
 
 class LogItem(object):
     def __init__(self):
         self.params = {}
 
+    def stamp(self):
+        """Fixes the item's time to now, for an item that is sent later"""
+        self.ts = int(time.time() * 1000)
+
     def serialize(self):
-        d = dict(type = self.type)
+        # Milliseconds since the epoch, so that the logs of the sessions
+        # of a build can be merged into one timeline
+        ts = getattr(self, 'ts', None) or int(time.time() * 1000)
+        d = dict(type = self.type, ts = ts)
         if self.params:
             d['params'] = self.params
         return json.dumps(d)
@@ -48,9 +63,11 @@ class StepJoinDone(LogItem):
 class StepDone(LogItem):
     type = 'step-done'
 
-    def __init__(self, name, time, log_start, log_end):
+    def __init__(self, name, time, log_start, log_end, cached = False):
         self.params = dict(name = name, time = int(time),
                            log_start = log_start, log_end = log_end)
+        if cached:
+            self.params['cached'] = True
 
 
 class JobBegun(LogItem):
@@ -82,6 +99,25 @@ class SetBuildId(LogItem):
         self.params = dict(build_id = build_uuid)
 
 
+class CommandDone(LogItem):
+    type = 'command-done'
+
+    def __init__(self, cmd, returncode, time, utime, stime, maxrss,
+                 timed_out = False):
+        self.params = dict(cmd = cmd, returncode = returncode,
+                           time = int(time), utime = int(utime),
+                           stime = int(stime), maxrss = maxrss)
+        if timed_out:
+            self.params['timed_out'] = True
+
+
+class AsyncStarted(LogItem):
+    type = 'async-started'
+
+    def __init__(self, name, session_id):
+        self.params = dict(name = name, session_id = session_id)
+
+
 class AsyncJoined(LogItem):
     type = 'async-joined'
 
@@ -98,3 +134,163 @@ class ArtifactAdded(LogItem):
                            url = url)
         if description:
             self.params['description'] = description
+
+
+def read_spool(filename):
+    with open(filename, "r") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def keep_spooled(filename, lines):
+    """Replaces the spool with the lines that are still to be sent"""
+    with open(filename + ".tmp", "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+    os.rename(filename + ".tmp", filename)
+
+
+def find_spools(sessions_path):
+    """Returns (session id, spool file) of the sessions that have items
+       spooled"""
+    return [(os.path.basename(os.path.dirname(filename)), filename)
+            for filename in glob.glob(os.path.join(sessions_path, "*",
+                                                   SPOOL_NAME))]
+
+
+def send_spool(client, session_id, filename, batch_size = BATCH_SIZE):
+    """Sends the items spooled for a session, in order
+
+       Returns False if the job server couldn't be reached. What
+       wasn't sent is then kept in the spool."""
+    lines = read_spool(filename)
+    for i in range(0, len(lines), batch_size):
+        try:
+            client.call('/slog/%s' % session_id,
+                        input = "\n".join(lines[i:i + batch_size]),
+                        raw = True)
+        except Exception, e:
+            print("Failed to send spooled slog of %s (%s)" % (session_id, e))
+            # Keep what is left, so nothing is sent twice
+            keep_spooled(filename, lines[i:])
+            return False
+    os.remove(filename)
+    return True
+
+
+class SlogWriter(threading.Thread):
+    """Streams log items to the job server in the background
+
+       Items are sent as newline-separated batches to /slog/<session>.
+       If the job server can't be reached, the batch is appended to a
+       spool file in the session directory and re-sent, in order,
+       before the next batch. Whatever is left in the spool when the
+       job ends is sent by the slave."""
+    def __init__(self, client, session, batch_size = BATCH_SIZE,
+                 linger = LINGER_TIME):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.session_id = session.id
+        self.url = '/slog/%s' % session.id
+        self.spool_file = os.path.join(session.path, SPOOL_NAME)
+        self.batch_size = batch_size
+        self.linger = linger
+        self.cv = threading.Condition()
+        self.items = []
+        self.queued = 0
+        self.done = 0
+        self.flush_requested = False
+        self.closed = False
+        self.spooled = os.path.exists(self.spool_file)
+
+    def put(self, item, flush = False):
+        with self.cv:
+            self.items.append(item.serialize())
+            self.queued += 1
+            if flush:
+                self.flush_requested = True
+            if flush or len(self.items) >= self.batch_size:
+                self.cv.notify_all()
+
+    def flush(self, timeout = None):
+        """Blocks until all queued items are either sent or spooled"""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cv:
+            target = self.queued
+            self.flush_requested = True
+            self.cv.notify_all()
+            while self.done < target and self.is_alive():
+                if timeout is None:
+                    self.cv.wait(1)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cv.wait(remaining)
+            return self.done >= target
+
+    def close(self):
+        self.flush()
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+        self.join()
+        if self.spooled:
+            print("WARNING: Could not send all slog items - they are "
+                  "left in %s for the slave to send" % self.spool_file)
+
+    def _next_batch(self):
+        with self.cv:
+            while not self.items and not self.closed:
+                self.cv.wait()
+            deadline = time.time() + self.linger
+            while not self.closed and not self.flush_requested and \
+                    len(self.items) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cv.wait(remaining)
+            batch = self.items
+            self.items = []
+            self.flush_requested = False
+            return batch
+
+    def _post(self, lines):
+        try:
+            self.client.call(self.url, input = "\n".join(lines), raw = True)
+            return True
+        except Exception, e:
+            print("Failed to send slog (%s) - spooling" % e)
+            return False
+
+    def _spool(self, lines):
+        with open(self.spool_file, "a") as f:
+            for line in lines:
+                f.write(line + "\n")
+        self.spooled = True
+
+    def _send_spool(self):
+        if not send_spool(self.client, self.session_id, self.spool_file,
+                          self.batch_size):
+            return False
+        self.spooled = False
+        return True
+
+    def _send(self, batch):
+        if self.spooled and not self._send_spool():
+            self._spool(batch)
+        elif not self._post(batch):
+            self._spool(batch)
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self._send(batch)
+            finally:
+                with self.cv:
+                    self.done += len(batch)
+                    self.cv.notify_all()
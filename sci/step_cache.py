@@ -0,0 +1,83 @@
+"""
+    sci.step_cache
+    ~~~~~~~~~~~~~~
+
+    Step Memoization
+
+    Steps can opt in to having their results remembered across builds
+    on the same slave. The key is made of the step's name, arguments,
+    selected environment variables and the recipe's hash.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, json, time, hashlib
+
+DEFAULT_TTL = 24 * 3600
+MAX_ENTRIES = 1000
+
+
+class StepCache(object):
+    def __init__(self, path, max_entries = MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+    @classmethod
+    def key(cls, *parts):
+        return hashlib.sha1(json.dumps(parts, sort_keys = True)).hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, "%s.json" % key)
+
+    def lookup(self, key):
+        """Returns the stored entry, or None"""
+        try:
+            with open(self._fname(key), "r") as f:
+                entry = json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+        if entry['expires'] < time.time():
+            self._remove(key)
+            return None
+        return entry
+
+    def store(self, key, entry, ttl = DEFAULT_TTL):
+        """Returns False if the entry can't be stored"""
+        entry = dict(entry, expires = time.time() + ttl)
+        try:
+            data = json.dumps(entry)
+        except (TypeError, ValueError):
+            # The return value isn't serializable
+            return False
+        fname = self._fname(key)
+        tmp_fname = "%s.tmp.%d" % (fname, os.getpid())
+        with open(tmp_fname, "w") as f:
+            f.write(data)
+        os.rename(tmp_fname, fname)
+        self.evict()
+        return True
+
+    def _remove(self, key):
+        try:
+            os.remove(self._fname(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes the oldest entries when there are too many"""
+        entries = []
+        for fname in os.listdir(self.path):
+            if not fname.endswith(".json"):
+                continue
+            try:
+                mtime = os.stat(os.path.join(self.path, fname)).st_mtime
+            except OSError:
+                continue
+            entries.append((mtime, fname[:-len(".json")]))
+        entries.sort()
+        for mtime, key in entries[:max(len(entries) - self.max_entries, 0)]:
+            self._remove(key)
@@ -0,0 +1,72 @@
+"""
+    sci.template
+    ~~~~~~~~~~~~
+
+    Template Rendering
+
+    Templates are strings with {{NAME}} placeholders. Each template
+    is split into its literal parts and variable names once, and the
+    result is cached, so rendering is a single join.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import re, threading
+from collections import OrderedDict
+
+re_var = re.compile("{{(.*?)}}")
+CACHE_SIZE = 512
+# Values may themselves contain placeholders, but not endlessly
+MAX_DEPTH = 10
+
+
+class MissingVariable(Exception):
+    def __init__(self, name):
+        Exception.__init__(self, "Failed to replace template variable %s" %
+                           name)
+        self.name = name
+
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def compile_template(tmpl):
+    """Returns (parts, names, occurrences), where parts is the template
+       split into [literal, name, literal, ..., name, literal], names
+       are the distinct variable names and occurrences all of them, in
+       order"""
+    with _lock:
+        compiled = _cache.pop(tmpl, None)
+        if compiled is None:
+            parts = re_var.split(tmpl)
+            occurrences = parts[1::2]
+            compiled = (parts, sorted(set(occurrences)), occurrences)
+            if len(_cache) >= CACHE_SIZE:
+                _cache.popitem(last = False)
+        _cache[tmpl] = compiled
+    return compiled
+
+
+def render(tmpl, lookup, depth = 0):
+    """Replaces the placeholders with lookup(name)
+
+       Every variable is looked up once, no matter how many times it
+       occurs. Raises MissingVariable if a value is missing or empty."""
+    parts, names, occurrences = compile_template(tmpl)
+    if not names:
+        return tmpl
+    values = {}
+    for name in names:
+        value = lookup(name)
+        if not value:
+            raise MissingVariable(name)
+        value = str(value)
+        if "{{" in value:
+            if depth >= MAX_DEPTH:
+                raise MissingVariable(name)
+            value = render(value, lookup, depth + 1)
+        values[name] = value
+    out = list(parts)
+    out[1::2] = map(values.__getitem__, occurrences)
+    return "".join(out)
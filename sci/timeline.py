@@ -0,0 +1,305 @@
+"""
+    sci.timeline
+    ~~~~~~~~~~~~
+
+    Build Timelines
+
+    Merges the slog streams of a session and of the async jobs it
+    started (recursively) into a trace that can be opened in
+    chrome://tracing, and works out where the time went: the critical
+    path through the sessions, and how long parents waited in joins
+    while a single child was still running.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, json
+from collections import OrderedDict
+
+
+class Span(object):
+    def __init__(self, name, cat, start, end, args = None):
+        self.name = name
+        self.cat = cat
+        self.start = start
+        self.end = end
+        self.args = args or {}
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class SessionLog(object):
+    """The spans of one session, built from its slog items
+
+       A session that crashed before it logged anything has no
+       timestamped items - it is `empty`, and has no start or end."""
+    def __init__(self, session_id, items):
+        self.id = session_id
+        self.spans = []
+        self.joins = []
+        # (time dispatched, step name, session id) of the async jobs
+        self.children = []
+        # session number -> the time the result was received
+        self.joined = {}
+        join_begun = {}
+        times = []
+        for item in items:
+            t = item.get('ts')
+            if t is None:
+                continue
+            times.append(t)
+            p = item.get('params', {})
+            type = item['type']
+            if type == 'step-done':
+                span = Span(p['name'], 'step', t - p['time'], t,
+                            dict(cached = p.get('cached', False)))
+                self.spans.append(span)
+                times.append(span.start)
+            elif type == 'step-join-begun':
+                join_begun[p['name']] = t
+            elif type == 'step-join-done':
+                span = Span(p['name'], 'join', join_begun.pop(p['name'], t), t)
+                self.spans.append(span)
+                self.joins.append(span)
+            elif type == 'command-done':
+                args = dict((k, p[k]) for k in ('returncode', 'utime',
+                                                'stime', 'maxrss'))
+                self.spans.append(Span(p['cmd'], 'command', t - p['time'],
+                                       t, args))
+            elif type == 'async-started':
+                self.children.append((t, p['name'], p['session_id']))
+            elif type == 'async-joined':
+                self.joined[str(p['session_no'])] = t
+        self.empty = not times
+        self.start = min(times) if times else None
+        self.end = max(times) if times else None
+
+    def joined_at(self, session_id):
+        return self.joined.get(session_id.split('-')[-1])
+
+
+def _lanes(spans):
+    """Assigns each span a lane in which it is either nested in, or
+       disjoint from, the other spans"""
+    lanes = []
+    for span in sorted(spans, key = lambda s: (s.start, -s.end)):
+        for i, stack in enumerate(lanes):
+            while stack and stack[-1].end <= span.start:
+                stack.pop()
+            if not stack or span.end <= stack[-1].end:
+                stack.append(span)
+                yield i, span
+                break
+        else:
+            lanes.append([span])
+            yield len(lanes) - 1, span
+
+
+def _time_with_one(intervals, start, end):
+    """Returns how long, between start and end, exactly one of the
+       intervals was open"""
+    edges = []
+    for a, b in intervals:
+        a, b = max(a, start), min(b, end)
+        if a < b:
+            edges.extend([(a, 1), (b, -1)])
+    edges.sort()
+    total, open, t = 0, 0, start
+    for when, delta in edges:
+        if open == 1:
+            total += when - t
+        open += delta
+        t = when
+    return total
+
+
+class Timeline(object):
+    def __init__(self, root_id):
+        self.root_id = root_id
+        self.sessions = OrderedDict()
+        # The ids of the sessions without timestamped items, which
+        # are left out
+        self.empty = []
+
+    @classmethod
+    def load(cls, root_id, fetch):
+        """Loads a session and all sessions started from it, where
+           `fetch` returns the slog items of a session id"""
+        timeline = cls(root_id)
+        queue = [root_id]
+        while queue:
+            session_id = queue.pop(0)
+            if session_id in timeline.sessions or \
+                    session_id in timeline.empty:
+                continue
+            session = SessionLog(session_id, fetch(session_id))
+            if session.empty:
+                if session_id == root_id:
+                    raise ValueError("No timestamped slog items for %s" %
+                                     session_id)
+                print("No timestamped slog items for %s - left out of the "
+                      "timeline" % session_id)
+                timeline.empty.append(session_id)
+                continue
+            timeline.sessions[session_id] = session
+            queue.extend(child_id for _, _, child_id in session.children)
+        return timeline
+
+    @property
+    def root(self):
+        return self.sessions[self.root_id]
+
+    def trace(self):
+        """Returns the timeline in the Chrome trace event format"""
+        origin = self.root.start
+        us = lambda t: (t - origin) * 1000
+        pids = dict((s, i + 1) for i, s in enumerate(self.sessions))
+        events = []
+        flow_id = 0
+        for session in self.sessions.values():
+            pid = pids[session.id]
+            events.append(dict(ph = 'M', name = 'process_name', pid = pid,
+                               args = dict(name = session.id)))
+            events.append(dict(ph = 'M', name = 'process_sort_index',
+                               pid = pid, args = dict(sort_index = pid)))
+            for lane, span in _lanes(session.spans):
+                events.append(dict(ph = 'X', name = span.name, cat = span.cat,
+                                   pid = pid, tid = lane, ts = us(span.start),
+                                   dur = span.duration * 1000,
+                                   args = span.args))
+            for t, name, child_id in session.children:
+                child = self.sessions.get(child_id)
+                if child is None:
+                    continue
+                flow_id += 1
+                events.append(dict(ph = 's', name = name, cat = 'async',
+                                   id = flow_id, pid = pid, tid = 0,
+                                   ts = us(t)))
+                events.append(dict(ph = 'f', bp = 'e', name = name,
+                                   cat = 'async', id = flow_id,
+                                   pid = pids[child_id], tid = 0,
+                                   ts = us(child.start)))
+        return dict(traceEvents = events, displayTimeUnit = 'ms')
+
+    def critical_path(self):
+        """Returns the chain of segments that the build's duration is
+           made up of, as (kind, session id, start, end), in order.
+
+           'run' is time spent in a session, 'dispatch' the time until
+           a child started and 'result' the time until the parent got
+           its result."""
+        segments = []
+        self._critical(self.root, self.root.end, segments)
+        segments.reverse()
+        return segments
+
+    def _critical(self, session, t, segments):
+        while True:
+            # Of the children whose results were in by t, the one that
+            # finished last is what the session was waiting for
+            last = None
+            for dispatched, name, child_id in session.children:
+                child = self.sessions.get(child_id)
+                joined = session.joined_at(child_id)
+                if child is None or joined is None or joined > t:
+                    continue
+                if last is None or child.end > last[0].end:
+                    last = (child, dispatched, joined)
+            if last is None:
+                break
+            child, dispatched, joined = last
+            segments.append(('run', session.id, joined, t))
+            segments.append(('result', child.id, child.end, joined))
+            self._critical(child, child.end, segments)
+            segments.append(('dispatch', child.id, dispatched, child.start))
+            t = dispatched
+        segments.append(('run', session.id, session.start, t))
+
+    def waits(self):
+        """Returns, for every join, how long the parent waited and for
+           how much of that time a single one of the children it was
+           waiting for was still running"""
+        result = []
+        for session in self.sessions.values():
+            for join in session.joins:
+                # The children whose results came in during the join
+                running = []
+                for _, _, child_id in session.children:
+                    child = self.sessions.get(child_id)
+                    joined = session.joined_at(child_id)
+                    if child is not None and joined is not None and \
+                            join.start <= joined <= join.end:
+                        running.append((child.start, child.end))
+                result.append(dict(session = session.id, step = join.name,
+                                   wait = join.duration,
+                                   straggler = _time_with_one(
+                                       running, join.start, join.end)))
+        return result
+
+    def summary(self):
+        totals = dict(run = 0, dispatch = 0, result = 0)
+        for kind, _, start, end in self.critical_path():
+            totals[kind] += max(end - start, 0)
+        waits = self.waits()
+        return dict(duration = self.root.end - self.root.start,
+                    sessions = len(self.sessions),
+                    empty = len(self.empty),
+                    critical_path = totals,
+                    join_wait = sum(w['wait'] for w in waits),
+                    straggler_wait = sum(w['straggler'] for w in waits))
+
+
+def fetch_slog(client, session_id):
+    """Fetches the slog items of a session from the job server"""
+    data = client.call('/slog/%s' % session_id, method = 'GET', raw = True)
+    return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+
+def read_slog(path, session_id):
+    """Reads the slog items of a session from `<path>/<session id>.slog`"""
+    with open(os.path.join(path, session_id + '.slog')) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    from optparse import OptionParser
+    from .http_client import HttpClient
+
+    usage = "usage: %prog [options] session-id"
+    parser = OptionParser(usage=usage)
+    parser.add_option("--job-server", dest="job_server",
+                      help="fetch the logs from this job server")
+    parser.add_option("--dir", dest="dir",
+                      help="read the logs from <dir>/<session-id>.slog")
+    parser.add_option("-o", "--output", dest="output",
+                      default="timeline.json",
+                      help="where to write the trace")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1 or not (opts.job_server or opts.dir):
+        parser.error("Need a session id and --job-server or --dir")
+
+    if opts.job_server:
+        client = HttpClient(opts.job_server)
+        fetch = lambda session_id: fetch_slog(client, session_id)
+    else:
+        fetch = lambda session_id: read_slog(opts.dir, session_id)
+    timeline = Timeline.load(args[0], fetch)
+    with open(opts.output, "w") as f:
+        json.dump(timeline.trace(), f)
+
+    summary = timeline.summary()
+    print("Wrote %s (%d sessions, %.1f s)" % (opts.output,
+                                               summary['sessions'],
+                                               summary['duration'] / 1000.0))
+    print("Critical path:")
+    for kind, session_id, start, end in timeline.critical_path():
+        print("  %-8s %-30s %8.1f s" % (kind, session_id,
+                                         max(end - start, 0) / 1000.0))
+    print("Waiting in joins: %.1f s, of which %.1f s on a single child" %
+          (summary['join_wait'] / 1000.0, summary['straggler_wait'] / 1000.0))
+
+
+if __name__ == '__main__':
+    main()
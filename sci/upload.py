@@ -0,0 +1,168 @@
+"""
+    sci.upload
+    ~~~~~~~~~~
+
+    Artifact Uploads
+
+    Small files are sent to the storage server in a single PUT. Large
+    files are split into chunks that are uploaded in parallel, over
+    several connections, and that are retried one by one:
+
+      POST /f/<path>?uploads=1             -> {"upload_id": ...}
+      PUT  /f/<path>?upload_id=..&part=N   (chunk N)
+      GET  /f/<path>?upload_id=..          -> {"parts": [acked chunks]}
+      POST /f/<path>?upload_id=..&complete=1 -> {"status": "ok", "url": ..}
+
+    The upload id is remembered on disk, so an interrupted upload
+    continues with the chunks that the server hasn't acknowledged.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, json, mmap, time, hashlib
+from multiprocessing.pool import ThreadPool
+from .http_client import HttpError
+
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_THREADS = 4
+CHUNK_RETRIES = 3
+
+
+class UploadException(Exception):
+    pass
+
+
+def file_body(filename, offset = 0, size = None):
+    """Returns (a part of) a file in a form that httplib sends with a
+       single sendall() straight from the page cache, rather than
+       copying it through Python strings 8 kB at a time."""
+    if size is None:
+        size = os.path.getsize(filename) - offset
+    if size == 0:
+        return ""
+    # mmap offsets must be page aligned
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), size + offset - start, offset = start,
+                       access = mmap.ACCESS_READ)
+    return buffer(mm, offset - start, size)
+
+
+class Uploader(object):
+    def __init__(self, client, state_dir, threads = UPLOAD_THREADS,
+                 chunk_size = CHUNK_SIZE, threshold = MULTIPART_THRESHOLD):
+        self.client = client
+        self.state_dir = state_dir
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.threshold = threshold
+        self.multipart = True
+
+    def upload(self, local_filename, path, **params):
+        """Stores a file on the storage server and returns the result
+
+           `params` are sent along as query parameters."""
+        if self.multipart and os.path.getsize(local_filename) > self.threshold:
+            try:
+                return self._upload_multipart(local_filename, path, **params)
+            except HttpError, e:
+                if e.code not in (404, 405):
+                    raise
+                self.multipart = False
+        return self._upload_single(local_filename, path, **params)
+
+    def _upload_single(self, local_filename, path, **params):
+        return self.client.call(path, method = "PUT",
+                                input = file_body(local_filename), **params)
+
+    def _state_file(self, local_filename, path):
+        key = hashlib.sha1("%s:%s" % (local_filename, path)).hexdigest()
+        return os.path.join(self.state_dir, "%s.json" % key)
+
+    def _load_state(self, state_file, st):
+        try:
+            with open(state_file, "r") as f:
+                state = json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+        if state['size'] != st.st_size or state['mtime'] != st.st_mtime or \
+                state['chunk_size'] != self.chunk_size:
+            return None
+        return state
+
+    def _save_state(self, state_file, state):
+        try:
+            os.makedirs(self.state_dir)
+        except OSError:
+            pass
+        with open(state_file + ".tmp", "w") as f:
+            f.write(json.dumps(state))
+        os.rename(state_file + ".tmp", state_file)
+
+    def _acked_parts(self, path, upload_id):
+        try:
+            res = self.client.call(path, upload_id = upload_id)
+            return set(res['parts'])
+        except HttpError, e:
+            if e.code != 404:
+                raise
+            # The server has forgotten about this upload
+            return None
+
+    def _upload_chunk(self, local_filename, path, upload_id, part):
+        offset = part * self.chunk_size
+        size = min(self.chunk_size, os.path.getsize(local_filename) - offset)
+        chunk = file_body(local_filename, offset, size)
+        for attempt in range(CHUNK_RETRIES):
+            try:
+                res = self.client.call(path, method = "PUT", input = chunk,
+                                       upload_id = upload_id, part = part)
+                if res.get("status") != "ok":
+                    raise UploadException("Failed to store part %d of %s: %s"
+                                          % (part, local_filename,
+                                             res.get("status")))
+                return part
+            except Exception:
+                if attempt == CHUNK_RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def _upload_multipart(self, local_filename, path, **params):
+        st = os.stat(local_filename)
+        nparts = (st.st_size + self.chunk_size - 1) / self.chunk_size
+        state_file = self._state_file(local_filename, path)
+        state = self._load_state(state_file, st)
+        acked = None
+        if state:
+            acked = self._acked_parts(path, state['upload_id'])
+        if acked is None:
+            res = self.client.call(path, input = {'size': st.st_size,
+                                                  'chunk_size': self.chunk_size},
+                                   uploads = 1)
+            state = {'upload_id': res['upload_id'],
+                     'size': st.st_size,
+                     'mtime': st.st_mtime,
+                     'chunk_size': self.chunk_size}
+            self._save_state(state_file, state)
+            acked = set()
+
+        upload_id = state['upload_id']
+        missing = [part for part in range(nparts) if part not in acked]
+        pool = ThreadPool(min(self.threads, max(len(missing), 1)))
+        try:
+            pending = [pool.apply_async(self._upload_chunk,
+                                        (local_filename, path, upload_id,
+                                         part))
+                       for part in missing]
+            for p in pending:
+                p.get()
+        finally:
+            pool.close()
+            pool.join()
+
+        result = self.client.call(path, input = {'parts': nparts},
+                                  upload_id = upload_id, complete = 1,
+                                  **params)
+        os.remove(state_file)
+        return result
@@ -7,7 +7,9 @@
     :copyright: (c) 2011 by Victor Boivie
     :license: Apache License 2.0
 """
-import random, hashlib
+import os, random, hashlib, time, ConfigParser
+
+HASH_BLOCK_SIZE = 1024 * 1024
 
 
 def random_bytes(size):
@@ -16,3 +18,82 @@ def random_bytes(size):
 
 def random_sha1():
     return hashlib.sha1(random_bytes(20)).hexdigest()
+
+
+def _sha1_entry(cache_path, filename, st):
+    key = "%s\0%r\0%d" % (os.path.realpath(filename), st.st_mtime,
+                          st.st_size)
+    return os.path.join(cache_path, hashlib.sha1(key).hexdigest())
+
+
+def file_sha1(filename, cache_path = None):
+    """Returns the SHA-1 of a file's contents
+
+       With `cache_path`, the digest is stored there for as long as
+       the file keeps its path, modification time and size, so that
+       later jobs hashing it again get it for free."""
+    st = os.stat(filename)
+    entry = None
+    if cache_path:
+        entry = _sha1_entry(cache_path, filename, st)
+        try:
+            with open(entry, "r") as f:
+                digest = f.read()
+            if len(digest) == 40:
+                return digest
+        except IOError:
+            pass
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    digest = h.hexdigest()
+    if entry:
+        try:
+            os.makedirs(cache_path)
+        except OSError:
+            pass
+        tmp_filename = "%s.tmp.%d" % (entry, os.getpid())
+        with open(tmp_filename, "w") as f:
+            f.write(digest)
+        os.rename(tmp_filename, entry)
+    return digest
+
+
+def prune_sha1_cache(cache_path, max_age):
+    """Removes the digests that were stored more than `max_age`
+       seconds ago"""
+    try:
+        names = os.listdir(cache_path)
+    except OSError:
+        return
+    oldest = time.time() - max_age
+    for name in names:
+        try:
+            entry = os.path.join(cache_path, name)
+            if os.stat(entry).st_mtime < oldest:
+                os.remove(entry)
+        except OSError:
+            pass
+
+
+def load_node_id(path):
+    """Returns the node id stored in `path`/config.ini, creating one
+       the first time"""
+    fname = os.path.join(path, "config.ini")
+    c = ConfigParser.ConfigParser()
+    c.read(fname)
+    try:
+        return c.get("sci", "node_id")
+    except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+        pass
+    node_id = 'A' + random_sha1()
+    c = ConfigParser.ConfigParser()
+    c.add_section('sci')
+    c.set("sci", "node_id", node_id)
+    with open(fname, "wb") as configfile:
+        c.write(configfile)
+    return node_id
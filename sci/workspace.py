@@ -0,0 +1,131 @@
+"""
+    sci.workspace
+    ~~~~~~~~~~~~~
+
+    Persistent Workspaces
+
+    A recipe can ask for a named workspace, that is kept on the slave
+    after the session has ended and handed to the next session asking
+    for the same name. That way, checkouts and build trees can be
+    updated incrementally instead of being recreated every time.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, fcntl, hashlib, json, shutil, time
+
+MAX_WORKSPACES = 8
+MIN_FREE_BYTES = 20 * 1024 * 1024 * 1024
+# Sessions running at the same time with the same key get different
+# copies, up to this many.
+MAX_INSTANCES = 4
+
+
+class Lease(object):
+    """A workspace that is locked for the current process"""
+    def __init__(self, key, path, lock):
+        self.key = key
+        self.path = path
+        self.lock = lock
+
+    def release(self):
+        if self.lock:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+
+
+class WorkspacePool(object):
+    """Workspaces kept under `path`, one directory per key
+
+       The lock on a workspace is an flock, so it is released even if
+       the session crashes. Workspaces that aren't locked are evicted,
+       least recently used first, when there are more than
+       `max_workspaces` of them or the disk has less than
+       `min_free` bytes left."""
+    def __init__(self, path, max_workspaces = MAX_WORKSPACES,
+                 min_free = MIN_FREE_BYTES):
+        # Absolute, since the sessions' workspaces link to it
+        self.path = os.path.abspath(path)
+        self.max_workspaces = max_workspaces
+        self.min_free = min_free
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass
+
+    def _try_lock(self, name):
+        filename = os.path.join(self.path, name + ".lock")
+        lock = open(filename, "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return None
+        # The workspace may have been evicted, and its lock file
+        # removed, while we were waiting for it
+        try:
+            if os.stat(filename).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock
+        except OSError:
+            pass
+        lock.close()
+        return None
+
+    def _touch(self, name, key):
+        meta = os.path.join(self.path, name + ".json")
+        with open(meta + ".tmp", "w") as f:
+            f.write(json.dumps({"key": key, "last_used": time.time()}))
+        os.rename(meta + ".tmp", meta)
+
+    def lease(self, key):
+        """Locks a workspace for `key` and returns a Lease, or None if
+           all copies of it are in use"""
+        digest = hashlib.sha1(key).hexdigest()
+        for instance in range(MAX_INSTANCES):
+            name = "%s.%d" % (digest, instance)
+            lock = self._try_lock(name)
+            if not lock:
+                continue
+            path = os.path.join(self.path, name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self._touch(name, key)
+            self.evict()
+            return Lease(key, path, lock)
+        return None
+
+    def _free_bytes(self):
+        st = os.statvfs(self.path)
+        return st.f_bavail * st.f_frsize
+
+    def evict(self):
+        entries = []
+        for fname in os.listdir(self.path):
+            if not fname.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.path, fname), "r") as f:
+                    last_used = json.loads(f.read())["last_used"]
+            except (IOError, ValueError, KeyError):
+                continue
+            entries.append((last_used, fname[:-len(".json")]))
+        entries.sort()
+        count = len(entries)
+        for last_used, name in entries:
+            if count <= self.max_workspaces and \
+                    self._free_bytes() >= self.min_free:
+                break
+            lock = self._try_lock(name)
+            if not lock:
+                # In use
+                continue
+            try:
+                print("Evicting workspace %s" % name)
+                os.remove(os.path.join(self.path, name + ".json"))
+                shutil.rmtree(os.path.join(self.path, name),
+                              ignore_errors = True)
+                os.remove(os.path.join(self.path, name + ".lock"))
+                count -= 1
+            finally:
+                lock.close()
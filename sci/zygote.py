@@ -0,0 +1,224 @@
+"""
+    sci.zygote
+    ~~~~~~~~~~
+
+    Pre-forked Job Processes
+
+    Starting a new interpreter for every job means importing all of
+    SCI (and everything it uses) again before the recipe even starts.
+    The zygote is a long-lived process that has done those imports
+    once, and forks a ready child for each job instead.
+
+    The slave talks to it over a unix socket. Each job is a separate
+    connection: the request is one JSON line, and the zygote answers
+    with the child's pid and, once the child exits, its return code
+    (negative if it was killed by a signal, just like Popen). The
+    children don't depend on the zygote: if it dies, they go on, but
+    their return codes are lost.
+
+    :copyright: (c) 2011 by Victor Boivie
+    :license: Apache License 2.0
+"""
+import os, sys, json, socket, select, signal, errno, random, time, fcntl
+import subprocess, traceback
+
+# Import everything a job uses, so the children don't have to.
+import httplib, urllib, urlparse, zipfile, zlib, hashlib, mmap
+import multiprocessing.pool
+from .bootstrap import Bootstrap
+from . import build
+
+START_TIMEOUT = 10
+# How often to check if a job is still there, once the zygote is gone
+ORPHAN_POLL_INTERVAL = 1
+
+
+def _run_child(req):
+    rc = 1
+    try:
+        random.seed()
+        fd = os.open(req['logfile'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0644)
+        null = os.open("/dev/null", os.O_RDONLY)
+        os.dup2(null, 0)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(null)
+        os.close(fd)
+        Bootstrap.run(req['job_server'], req['session_id'], req['info'])
+        rc = 0
+    except SystemExit, e:
+        rc = e.code if isinstance(e.code, int) else 1
+    except:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(rc)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def serve(socket_path):
+    """The zygote's main loop"""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+    parent = os.getppid()
+
+    # Child exits are turned into something select() can wait for
+    rpipe, wpipe = os.pipe()
+    for fd in (rpipe, wpipe):
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def on_sigchld(signum, frame):
+        try:
+            os.write(wpipe, "x")
+        except OSError:
+            pass
+    signal.signal(signal.SIGCHLD, on_sigchld)
+
+    children = {}
+    while os.getppid() == parent:
+        try:
+            r, w, x = select.select([listener, rpipe], [], [], 5)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if rpipe in r:
+            try:
+                os.read(rpipe, 4096)
+            except OSError:
+                pass
+            while children:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if pid == 0:
+                    break
+                conn = children.pop(pid, None)
+                if conn:
+                    try:
+                        conn.sendall(json.dumps({'returncode':
+                                                 _exit_code(status)}) + "\n")
+                    except socket.error:
+                        pass
+                    conn.close()
+        if listener in r:
+            conn, addr = listener.accept()
+            req = json.loads(conn.makefile("r").readline())
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                listener.close()
+                conn.close()
+                os.close(rpipe)
+                os.close(wpipe)
+                for c in children.values():
+                    c.close()
+                _run_child(req)
+            children[pid] = conn
+            conn.sendall(json.dumps({'pid': pid}) + "\n")
+
+
+class ZygoteChild(object):
+    """A job forked by the zygote, with the same wait() as Popen
+
+       If the zygote dies, the job is `orphaned`: wait() then waits
+       for its pid to go away, and returns None as the return code
+       is lost."""
+    def __init__(self, sock, f, pid):
+        self.sock = sock
+        self.f = f
+        self.pid = pid
+        self.returncode = None
+        self.orphaned = False
+
+    def read_result(self):
+        """Reads the return code, once the zygote sends it. Blocks
+           until then, unless `sock` is readable."""
+        line = self.f.readline()
+        if line:
+            self.returncode = json.loads(line)['returncode']
+        else:
+            print("Lost the zygote - waiting for pid %d on its own" %
+                  self.pid)
+            self.orphaned = True
+        self.sock.close()
+
+    def running(self):
+        """Whether the process is still there. Only of use once the
+           job is orphaned - it isn't our child, so it can't be waited
+           for."""
+        try:
+            os.kill(self.pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def wait(self):
+        if self.returncode is None and not self.orphaned:
+            self.read_result()
+        while self.orphaned and self.running():
+            time.sleep(ORPHAN_POLL_INTERVAL)
+        return self.returncode
+
+
+class Zygote(object):
+    """The slave's handle to the zygote process"""
+    def __init__(self, run_job, path):
+        self.run_job = run_job
+        self.path = path
+        self.socket_path = os.path.join(path, "zygote.sock")
+        self.proc = None
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.proc = subprocess.Popen([sys.executable, self.run_job,
+                                      "--zygote", self.socket_path],
+                                     cwd = self.path)
+        deadline = time.time() + START_TIMEOUT
+        while not os.path.exists(self.socket_path):
+            if self.proc.poll() is not None or time.time() > deadline:
+                raise Exception("The zygote failed to start")
+            time.sleep(0.05)
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+    def spawn(self, job_server, session_id, info, logfile):
+        """Forks a child running the job. Returns None if the zygote
+           couldn't be reached."""
+        if not self.proc or self.proc.poll() is not None:
+            try:
+                self.start()
+            except Exception, e:
+                print("Failed to start zygote: %s" % e)
+                return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps({'job_server': job_server,
+                                     'session_id': session_id,
+                                     'info': info,
+                                     'logfile': logfile}) + "\n")
+            f = sock.makefile("r")
+            return ZygoteChild(sock, f, json.loads(f.readline())['pid'])
+        except (socket.error, ValueError), e:
+            print("Failed to fork from zygote: %s" % e)
+            sock.close()
+            return None
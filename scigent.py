@@ -2,7 +2,6 @@
 import os, sys
 from optparse import OptionParser
 
-from sci.slave import Slave
 
 DEFAULT_PORT = 6700
 
@@ -15,13 +14,27 @@ parser.add_option("--path", dest="path", default=".",
                   help="path to use")
 parser.add_option("--nick", dest="nick", default=hostname,
                   help="nickname")
+parser.add_option("--slots", dest="slots", default=1,
+                  help="number of jobs to run concurrently")
+parser.add_option("--zygote", dest="zygote", action="store_true",
+                  default=False,
+                  help="fork jobs from a pre-started process")
+parser.add_option("--evloop", dest="evloop", action="store_true",
+                  default=False,
+                  help="run everything on a single event loop")
 (opts, args) = parser.parse_args()
 
 if len(args) == 0:
     print >> sys.stderr, "Missing jobserver (or 'stop' to exit)"
     sys.exit(1)
 
+if opts.evloop:
+    from sci.agent import Agent as Slave
+else:
+    from sci.slave import Slave
+
 if args[0] == 'stop':
     Slave(opts.nick, '', 0, '').stop()
 else:
-    Slave(opts.nick, args[0], int(opts.port), opts.path).start()
+    Slave(opts.nick, args[0], int(opts.port), opts.path,
+          int(opts.slots), opts.zygote).start()